@@ -1,62 +1,432 @@
+import atexit
 import logging
 import json
 import os
+import queue
+import random
+import re
+import threading
 import time
 from logging.handlers import RotatingFileHandler
 
+from log_archive import ArchivingFileHandler
+from tracing import current_span
+
+# What to do with a record when the async queue is full:
+#   block      - wait for room (never loses records)
+#   drop_debug - drop DEBUG/INFO records, wait for room for WARNING and above
+#   sample     - once the queue is 80% full keep only sample_rate of the
+#                DEBUG/INFO records, wait for room for WARNING and above
+OVERFLOW_POLICIES = ("block", "drop_debug", "sample")
+
+TIMESTAMP_FORMATS = ("asctime", "epoch_ns")
+
+# Numbers (ids, amounts, durations) vary between otherwise identical messages
+_TEMPLATE_DIGITS = re.compile(r"\d+")
+# Shared bucket for templates beyond max_templates
+_OVERFLOW_TEMPLATE = "__overflow__"
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object with a single encoding pass.
+
+    The output keeps the shape of the original template formatter:
+    {"timestamp": ..., "level": ..., "message": {"content": ..., **fields},
+    "service": ...}. Only the message object is encoded per record; the
+    encoded level names and service suffix are cached, and the asctime
+    prefix is reused for every record within the same second. With
+    timestamp_format="epoch_ns" the timestamp is an integer in nanoseconds.
+    """
+
+    def __init__(self, service, timestamp_format="asctime"):
+        super().__init__()
+        if timestamp_format not in TIMESTAMP_FORMATS:
+            raise ValueError(f"timestamp_format must be one of {TIMESTAMP_FORMATS}")
+        self.service = service
+        self.timestamp_format = timestamp_format
+        self._suffix = ', "service": ' + json.dumps(service) + "}"
+        self._levels = {}
+        # One reusable encoder; json.dumps(..., default=...) builds a new one per call
+        self._encode = json.JSONEncoder(default=str).encode
+        self._second = None
+        self._second_text = None
+
+    def _timestamp(self, record):
+        if self.timestamp_format == "epoch_ns":
+            created_ns = getattr(record, "created_ns", None)
+            if created_ns is None:
+                created_ns = int(record.created * 1e9)
+            return str(created_ns)
+        second = int(record.created)
+        if second != self._second:
+            self._second_text = '"' + time.strftime("%Y-%m-%d %H:%M:%S", self.converter(second))
+            self._second = second
+        return f'{self._second_text},{int(record.msecs):03d}"'
+
+    def format(self, record):
+        level = self._levels.get(record.levelname)
+        if level is None:
+            level = self._levels[record.levelname] = json.dumps(record.levelname)
+
+        message = {"content": record.getMessage()}
+        fields = getattr(record, "fields", None)
+        if fields:
+            message.update(fields)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message["exception"] = record.exc_text
+
+        return ('{"timestamp": ' + self._timestamp(record) + ', "level": ' + level
+                + ', "message": ' + self._encode(message) + self._suffix)
+
+class AsyncLogWriter:
+    """Background thread that formats and writes queued log records in batches.
+
+    The calling thread only enqueues the record. The writer drains up to
+    batch_size records at a time, writes them to each handler and flushes
+    every handler once per batch instead of once per record.
+    """
+    _STOP = object()
+
+    def __init__(self, handlers, queue_size=10000, overflow_policy="block",
+                 sample_rate=0.1, batch_size=256, flush_interval=0.5,
+                 dropped_counter=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow_policy must be one of {OVERFLOW_POLICIES}")
+        self.handlers = handlers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.high_water = int(queue_size * 0.8)
+        # Records dropped by the overflow policy, per level name
+        self.dropped = {}
+        self.dropped_counter = dropped_counter
+        self._closed = False
+
+        self.thread = threading.Thread(target=self._run, name="async-log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, record):
+        if self._closed:
+            # After shutdown fall back to writing on the calling thread
+            self._write_batch([record])
+            return
+
+        important = record.levelno >= logging.WARNING
+        if self.overflow_policy == "block" or important:
+            self.queue.put(record)
+            return
+        if self.overflow_policy == "sample" and self.queue.qsize() >= self.high_water:
+            if random.random() >= self.sample_rate:
+                self._drop(record)
+                return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop(record)
+
+    def _drop(self, record):
+        self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+        if self.dropped_counter is not None:
+            self.dropped_counter.labels(record.levelname).inc()
+
+    def _run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            stop = record is self._STOP
+            if not stop:
+                batch.append(record)
+            while len(batch) < self.batch_size and not stop:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is self._STOP:
+                    stop = True
+                else:
+                    batch.append(record)
+            if batch:
+                self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, records):
+        for handler in self.handlers:
+            if not isinstance(handler, logging.StreamHandler):
+                for record in records:
+                    handler.handle(record)
+                continue
+
+            handler.acquire()
+            try:
+                for record in records:
+                    if record.levelno < handler.level or not handler.filter(record):
+                        continue
+                    try:
+                        msg = handler.format(record) + handler.terminator
+                        if isinstance(handler, ArchivingFileHandler):
+                            if handler.rollover_due(len(msg)):
+                                handler.doRollover()
+                            handler.track(record.created)
+                        elif isinstance(handler, RotatingFileHandler):
+                            if handler.stream is None:
+                                handler.stream = handler._open()
+                            if handler.maxBytes > 0 and handler.stream.tell() + len(msg) >= handler.maxBytes:
+                                handler.doRollover()
+                        handler.stream.write(msg)
+                    except Exception:
+                        handler.handleError(record)
+                handler.flush()
+            finally:
+                handler.release()
+
+    def close(self):
+        """Write out every queued record and stop the writer thread"""
+        if self._closed:
+            return
+        self.queue.put(self._STOP)
+        self.thread.join()
+        self._closed = True
+
+        # Records enqueued while the writer was stopping
+        leftover = []
+        while True:
+            try:
+                leftover.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftover:
+            self._write_batch(leftover)
+
+class _TemplateBucket:
+    __slots__ = ("tokens", "updated", "seen", "suppressed")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+        self.seen = 0
+        self.suppressed = 0
+
+class LogRateLimiter:
+    """Token bucket per (level, message template) for repetitive log records.
+
+    The template is the message with every run of digits replaced by '#', so
+    "Transaction 1234 failed" and "Transaction 5678 failed" share a bucket.
+    The first always_keep records of a template are always written; after
+    that each template may write rate records per second with bursts of up
+    to burst. Suppressed records are counted, and every summary_interval
+    seconds one "Suppressed K similar records" WARNING is written per
+    template that lost records.
+
+    allow() is a dict lookup and a few float operations without a lock:
+    concurrent updates of one bucket can miscount by a record, which is fine
+    for sampling. Only creating a bucket and emitting summaries take a lock.
+    """
+
+    def __init__(self, rate=10.0, burst=20, always_keep=10, summary_interval=10.0,
+                 max_templates=10000, suppressed_counter=None):
+        self.rate = rate
+        self.burst = burst
+        self.always_keep = always_keep
+        self.summary_interval = summary_interval
+        self.max_templates = max_templates
+        self.suppressed_counter = suppressed_counter
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._next_summary = time.monotonic() + summary_interval
+
+    def _bucket(self, key, now):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_templates:
+                    key = (key[0], _OVERFLOW_TEMPLATE)
+                    bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = _TemplateBucket(self.burst, now)
+            return bucket
+
+    def allow(self, levelno, message):
+        """Return True if a record with this level and message should be written"""
+        now = time.monotonic()
+        key = (levelno, _TEMPLATE_DIGITS.sub("#", message))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._bucket(key, now)
+
+        bucket.seen += 1
+        if bucket.seen <= self.always_keep:
+            return True
+        tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if tokens >= 1:
+            bucket.tokens = tokens - 1
+            return True
+        bucket.tokens = tokens
+        bucket.suppressed += 1
+        if self.suppressed_counter is not None:
+            self.suppressed_counter.labels(logging.getLevelName(levelno)).inc()
+        return False
+
+    def summaries_due(self):
+        return time.monotonic() >= self._next_summary
+
+    def take_summaries(self):
+        """Return [(levelno, template, suppressed)] since the last call and reset them"""
+        # Only one thread collects; the others keep logging
+        if not self._lock.acquire(blocking=False):
+            return []
+        try:
+            self._next_summary = time.monotonic() + self.summary_interval
+            summaries = []
+            for (levelno, template), bucket in self._buckets.items():
+                if bucket.suppressed:
+                    summaries.append((levelno, template, bucket.suppressed))
+                    bucket.suppressed = 0
+            return summaries
+        finally:
+            self._lock.release()
+
+class _EnqueueHandler(logging.Handler):
+    """Hands records to an AsyncLogWriter instead of writing them"""
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+
+    def emit(self, record):
+        # Resolve the message now so later changes to args cannot leak in
+        record.msg = record.getMessage()
+        record.args = None
+        self.writer.enqueue(record)
+
 class AdvancedLogger:
-    def __init__(self, app_name, log_dir="logs"):
+    def __init__(self, app_name, log_dir="logs", async_mode=False, queue_size=10000,
+                 overflow_policy="block", sample_rate=0.1, metrics=None,
+                 timestamp_format="asctime", rate_limiter=None, rotate_interval=86400,
+                 archive_dir=None, retention_days=None):
         self.app_name = app_name
         self.log_dir = log_dir
-        
+        self.epoch_ns = timestamp_format == "epoch_ns"
+        self.rate_limiter = rate_limiter
+        if rate_limiter is not None and metrics is not None and rate_limiter.suppressed_counter is None:
+            rate_limiter.suppressed_counter = metrics.counter(
+                "log_records_suppressed_total",
+                "Log records suppressed by the per-template rate limiter",
+                labels=["level"]
+            )
+
         # Create log directory if it doesn't exist
         os.makedirs(log_dir, exist_ok=True)
-        
+
         # Set up formatter
-        formatter = logging.Formatter(
-            '{"timestamp": "%(asctime)s", "level": "%(levelname)s", "message": %(message)s, "service": "' + app_name + '"}'
-        )
-        
+        formatter = JsonFormatter(app_name, timestamp_format)
+
         # Create logger
         self.logger = logging.getLogger(app_name)
         self.logger.setLevel(logging.DEBUG)
-        
+
         # Clear existing handlers
         if self.logger.handlers:
             self.logger.handlers.clear()
-        
+
         # Console handler
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
-        
-        # File handler with rotation
-        file_handler = RotatingFileHandler(
-            f"{log_dir}/{app_name}.log", 
-            maxBytes=10485760,  # 10MB
-            backupCount=5
+
+        # File handler rotated at 10MB or daily; rotated segments are
+        # compressed into <log_dir>/archive in the background
+        file_handler = ArchivingFileHandler(
+            f"{log_dir}/{app_name}.log",
+            max_bytes=10485760,  # 10MB
+            interval=rotate_interval,
+            archive_dir=archive_dir,
+            retention_days=retention_days
         )
         file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
-        
+
         # Error file handler
-        error_handler = RotatingFileHandler(
-            f"{log_dir}/{app_name}-error.log", 
-            maxBytes=10485760,  # 10MB
-            backupCount=5
+        error_handler = ArchivingFileHandler(
+            f"{log_dir}/{app_name}-error.log",
+            max_bytes=10485760,  # 10MB
+            interval=rotate_interval,
+            archive_dir=archive_dir,
+            retention_days=retention_days
         )
         error_handler.setLevel(logging.ERROR)
         error_handler.setFormatter(formatter)
-        self.logger.addHandler(error_handler)
-    
+
+        handlers = [console_handler, file_handler, error_handler]
+        self.writer = None
+        if async_mode:
+            # Request threads only enqueue; a background thread writes
+            dropped_counter = None
+            if metrics is not None:
+                dropped_counter = metrics.counter(
+                    "log_records_dropped_total",
+                    "Log records dropped because the async log queue was full",
+                    labels=["level"]
+                )
+            self.writer = AsyncLogWriter(handlers, queue_size=queue_size,
+                                         overflow_policy=overflow_policy,
+                                         sample_rate=sample_rate,
+                                         dropped_counter=dropped_counter)
+            self.logger.addHandler(_EnqueueHandler(self.writer))
+            atexit.register(self.close)
+        else:
+            for handler in handlers:
+                self.logger.addHandler(handler)
+
+    def _log(self, level, message, fields):
+        # Fields are encoded together with the rest of the record by JsonFormatter
+        if self.logger.isEnabledFor(level):
+            if self.rate_limiter is not None:
+                if self.rate_limiter.summaries_due():
+                    self._log_summaries()
+                if not self.rate_limiter.allow(level, message):
+                    return
+            # Records logged inside a span carry its ids so logs join with traces
+            span = current_span()
+            if span is not None:
+                fields.setdefault("trace_id", span.trace_id)
+                fields.setdefault("span_id", span.span_id)
+            extra = {"fields": fields}
+            if self.epoch_ns:
+                extra["created_ns"] = time.time_ns()
+            self.logger.log(level, message, extra=extra)
+
+    def _log_summaries(self):
+        # Written directly so the summaries themselves are never rate limited
+        for levelno, template, suppressed in self.rate_limiter.take_summaries():
+            self.logger.log(logging.WARNING, f"Suppressed {suppressed} similar records", extra={
+                "fields": {"template": template, "level": logging.getLevelName(levelno),
+                           "suppressed": suppressed}
+            })
+
     def info(self, message, **kwargs):
-        self.logger.info(json.dumps({"content": message, **kwargs}))
-    
+        self._log(logging.INFO, message, kwargs)
+
     def error(self, message, **kwargs):
-        self.logger.error(json.dumps({"content": message, **kwargs}))
-    
+        self._log(logging.ERROR, message, kwargs)
+
     def warn(self, message, **kwargs):
-        self.logger.warning(json.dumps({"content": message, **kwargs}))
-    
+        self._log(logging.WARNING, message, kwargs)
+
     def debug(self, message, **kwargs):
-        self.logger.debug(json.dumps({"content": message, **kwargs}))
\ No newline at end of file
+        self._log(logging.DEBUG, message, kwargs)
+
+    def close(self):
+        """Drain the async queue (if any) and flush all handlers"""
+        if self.rate_limiter is not None:
+            self._log_summaries()
+        if self.writer is not None:
+            self.writer.close()
+            for handler in self.writer.handlers:
+                handler.flush()
@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import json
+import random
+import ssl
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from simulate_load import ResultRecorder, generate_transaction, merge_worker_results
+from tracing import new_traceparent
+
+class HTTPConnectionPool:
+    """Minimal HTTP/1.1 keep-alive connection pool on asyncio streams.
+
+    Idle connections are reused across requests so a run does not pay a TCP
+    handshake per transaction. At most max_connections are open at once;
+    further requests wait for a free connection, and that wait counts toward
+    their measured latency.
+    """
+
+    def __init__(self, server_url, max_connections=100, timeout=30):
+        parts = urlsplit(server_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self):
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def request(self, method, path, body=b"", headers=None):
+        """Send one request and return (status, response body bytes)"""
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = await self._connect()
+            try:
+                try:
+                    status, response_body, keep_alive = await asyncio.wait_for(
+                        self._send(connection, method, path, body, headers), self.timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server closed an idle keep-alive connection; retry once fresh
+                    connection[1].close()
+                    connection = await self._connect()
+                    status, response_body, keep_alive = await asyncio.wait_for(
+                        self._send(connection, method, path, body, headers), self.timeout
+                    )
+            except BaseException:
+                connection[1].close()
+                raise
+            if keep_alive:
+                self._idle.append(connection)
+            else:
+                connection[1].close()
+            return status, response_body
+
+    async def _send(self, connection, method, path, body, headers):
+        reader, writer = connection
+        lines = [f"{method} {self.base_path}{path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                 f"Content-Length: {len(body)}", "Connection: keep-alive"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await reader.readuntil(b"\r\n")
+        version, status = status_line.split(b" ", 2)[:2]
+        response_headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readuntil(b"\r\n")
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            response_body = b"".join(chunks)
+            framed = True
+        elif "content-length" in response_headers:
+            response_body = await reader.readexactly(int(response_headers["content-length"]))
+            framed = True
+        else:
+            # No framing: the body runs until the server closes the connection
+            response_body = await reader.read()
+            framed = False
+
+        connection_header = response_headers.get("connection", "").lower()
+        if version == b"HTTP/1.0":
+            keep_alive = connection_header == "keep-alive"
+        else:
+            keep_alive = connection_header != "close"
+        return int(status), response_body, keep_alive and framed
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+class AsyncLoadTest:
+    """Asyncio load generator with closed-loop and open-loop modes.
+
+    closed: `users` virtual users each send a transaction, wait for the
+        response, think for a random 0.1-0.5s and repeat.
+    open: transactions arrive as a Poisson process at `rps` per second,
+        independent of how fast the server answers.
+
+    Latency is measured from the intended send time, not from when the
+    request was actually written, so queueing inside the generator (waiting
+    for a connection, a late event loop) is charged to the request instead
+    of being silently omitted.
+    """
+
+    def __init__(self, server_url="http://localhost:5000", mode="closed", users=50,
+                 rps=50.0, duration=30.0, transactions_per_user=None, connections=100,
+                 max_in_flight=10000, think_time=(0.1, 0.5), on_result=None):
+        if mode not in ("closed", "open"):
+            raise ValueError("mode must be 'closed' or 'open'")
+        self.server_url = server_url
+        self.mode = mode
+        self.users = users
+        self.rps = rps
+        self.duration = duration
+        self.transactions_per_user = transactions_per_user
+        self.connections = connections
+        self.max_in_flight = max_in_flight
+        self.think_time = think_time
+        # Called with every result dict; defaults to keeping them in memory
+        self.on_result = on_result
+        self.results = []
+        self._sequence = 0
+
+    def _record(self, result):
+        if self.on_result is not None:
+            self.on_result(result)
+        else:
+            self.results.append(result)
+
+    async def _send(self, pool, user_id, intended_time):
+        self._sequence += 1
+        transaction_id = self._sequence
+        body = json.dumps(generate_transaction()).encode("utf-8")
+        traceparent, trace_id = new_traceparent()
+        try:
+            status, _ = await pool.request(
+                "POST", "/api/transactions", body,
+                {"Content-Type": "application/json", "traceparent": traceparent}
+            )
+            self._record({
+                "transaction_id": transaction_id,
+                "thread_id": user_id,
+                "trace_id": trace_id,
+                "duration": time.monotonic() - intended_time,
+                "status_code": status,
+                "success": 200 <= status < 300,
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            self._record({
+                "transaction_id": transaction_id,
+                "thread_id": user_id,
+                "trace_id": trace_id,
+                "duration": time.monotonic() - intended_time,
+                "error": str(e) or type(e).__name__,
+                "success": False,
+                "timestamp": datetime.now().isoformat()
+            })
+
+    async def _closed_user(self, pool, user_id, deadline):
+        sent = 0
+        intended_time = time.monotonic()
+        while time.monotonic() < deadline:
+            if self.transactions_per_user is not None and sent >= self.transactions_per_user:
+                break
+            await self._send(pool, user_id, intended_time)
+            sent += 1
+            think = random.uniform(*self.think_time)
+            intended_time = time.monotonic() + think
+            await asyncio.sleep(think)
+
+    async def _open_loop(self, pool, deadline):
+        in_flight = set()
+        next_time = time.monotonic()
+        arrival = 0
+        while True:
+            next_time += random.expovariate(self.rps)
+            if next_time >= deadline:
+                break
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            arrival += 1
+            if len(in_flight) >= self.max_in_flight:
+                # Generator saturated: count the arrival as failed instead of
+                # delaying the schedule
+                self._sequence += 1
+                self._record({
+                    "transaction_id": self._sequence,
+                    "thread_id": arrival,
+                    "error": "generator saturated",
+                    "success": False,
+                    "timestamp": datetime.now().isoformat()
+                })
+                continue
+            task = asyncio.ensure_future(self._send(pool, arrival, next_time))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+    async def run_async(self):
+        pool = HTTPConnectionPool(self.server_url, self.connections)
+        start_time = time.monotonic()
+        deadline = start_time + self.duration if self.duration else float("inf")
+        try:
+            if self.mode == "open":
+                await self._open_loop(pool, deadline)
+            else:
+                await asyncio.gather(*(self._closed_user(pool, user_id, deadline)
+                                       for user_id in range(self.users)))
+        finally:
+            pool.close()
+        self.elapsed = time.monotonic() - start_time
+        return self.results
+
+    def run(self):
+        return asyncio.run(self.run_async())
+
+def run_async_load_test(server_url="http://localhost:5000", mode="closed", users=50, rps=50.0,
+                        duration=30.0, transactions_per_user=None, connections=100):
+    """Run an asyncio load test and write results and summary like run_load_test"""
+    recorder = ResultRecorder("async")
+    test = AsyncLoadTest(server_url, mode=mode, users=users, rps=rps, duration=duration,
+                         transactions_per_user=transactions_per_user, connections=connections,
+                         on_result=recorder.record)
+    try:
+        test.run()
+    finally:
+        recorder.close()
+
+    return merge_worker_results(["async"], extra={
+        "engine": "async",
+        "mode": mode,
+        "users": users if mode == "closed" else None,
+        "target_rps": rps if mode == "open" else None,
+        "achieved_rps": recorder.total / test.elapsed if test.elapsed else 0
+    })
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Asyncio load generator")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--users", type=int, default=50, help="Virtual users (closed mode)")
+    parser.add_argument("--rps", type=float, default=50.0, help="Arrival rate (open mode)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Test duration in seconds")
+    parser.add_argument("--transactions", type=int, help="Stop each user after this many (closed mode)")
+    parser.add_argument("--connections", type=int, default=100, help="Keep-alive connection pool size")
+    args = parser.parse_args()
+
+    run_async_load_test(args.url, args.mode, args.users, args.rps, args.duration,
+                        args.transactions, args.connections)
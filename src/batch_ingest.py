@@ -0,0 +1,114 @@
+import codecs
+import json
+
+# Bytes read from the request body at a time
+CHUNK_SIZE = 65536
+# A single record larger than this is treated as malformed
+MAX_RECORD_BYTES = 1048576
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl",
+                "application/x-jsonlines")
+
+def iter_ndjson(stream, chunk_size=CHUNK_SIZE):
+    """Yield (record, error) for each line of an NDJSON body, reading it in chunks.
+
+    A line that is not valid JSON yields (None, message) and parsing goes on
+    with the next line.
+    """
+    buffer = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        if len(buffer) > MAX_RECORD_BYTES:
+            yield None, f"Line longer than {MAX_RECORD_BYTES} bytes"
+            return
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+    if buffer.strip():
+        yield _parse_line(buffer)
+
+def _parse_line(line):
+    try:
+        return json.loads(line), None
+    except ValueError as e:
+        return None, f"Invalid JSON: {e}"
+
+class _TextBuffer:
+    """Decoded text of a byte stream, read on demand"""
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        # Characters already dropped from the front of text, for error offsets
+        self.consumed = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        # Drop what has been parsed so the buffer holds about one chunk
+        self.consumed += self.pos
+        self.text = self.text[self.pos:] + self.decoder.decode(chunk, final=not chunk)
+        self.pos = 0
+
+    def peek(self):
+        """Next non-whitespace character, or '' at the end of the body"""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos:self.pos + 1]
+            self.fill()
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    """Yield (record, error) for each element of a JSON array body, reading it in chunks.
+
+    Elements are decoded one at a time with raw_decode, so memory stays at
+    about one chunk plus one record however large the array is. A malformed
+    array cannot be resynchronized: it yields (None, message) once and stops.
+    """
+    decoder = json.JSONDecoder()
+    buffer = _TextBuffer(stream, chunk_size)
+    try:
+        if buffer.peek() != "[":
+            raise ValueError("Expected a JSON array")
+        buffer.pos += 1
+        if buffer.peek() == "]":
+            return
+        while True:
+            buffer.peek()
+            while True:
+                try:
+                    record, end = decoder.raw_decode(buffer.text, buffer.pos)
+                    # A value ending exactly at the buffer end may continue
+                    # (e.g. a number) in the next chunk
+                    if end < len(buffer.text) or buffer.eof:
+                        break
+                except ValueError:
+                    if buffer.eof or len(buffer.text) - buffer.pos > MAX_RECORD_BYTES:
+                        raise
+                buffer.fill()
+            buffer.pos = end
+            yield record, None
+
+            separator = buffer.peek()
+            buffer.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or ']' at offset {buffer.consumed + buffer.pos - 1}")
+    except ValueError as e:
+        yield None, f"Malformed JSON array: {e}"
+
+def iter_records(stream, mimetype, chunk_size=CHUNK_SIZE):
+    """Yield (record, error) pairs from an NDJSON or JSON array request body"""
+    if mimetype in NDJSON_TYPES:
+        return iter_ndjson(stream, chunk_size)
+    return iter_json_array(stream, chunk_size)
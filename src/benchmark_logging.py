@@ -0,0 +1,54 @@
+import argparse
+import json
+import logging
+import time
+
+from advanced_logging import JsonFormatter
+
+SERVICE = "fintech-app"
+
+def legacy_format(formatter, level, message, fields):
+    """The previous pipeline: json.dumps in the caller, then a template formatter"""
+    record = logging.LogRecord(SERVICE, level, __file__, 0,
+                               json.dumps({"content": message, **fields}), None, None)
+    return formatter.format(record)
+
+def json_format(formatter, level, message, fields):
+    """The current pipeline: fields ride on the record, encoded once"""
+    record = logging.LogRecord(SERVICE, level, __file__, 0, message, None, None)
+    record.fields = fields
+    return formatter.format(record)
+
+def measure(format_record, formatter, num_records):
+    fields = {"transaction_id": 4821, "amount": 125.5, "currency": "USD", "user_id": 1337}
+    start_time = time.perf_counter()
+    for i in range(num_records):
+        format_record(formatter, logging.INFO, f"Processing transaction {i}", fields)
+    return num_records / (time.perf_counter() - start_time)
+
+def run_benchmark(num_records=200000):
+    """Compare records/sec of the legacy template formatter and JsonFormatter"""
+    legacy = logging.Formatter(
+        '{"timestamp": "%(asctime)s", "level": "%(levelname)s", "message": %(message)s, "service": "' + SERVICE + '"}'
+    )
+    results = {
+        "legacy_template": measure(legacy_format, legacy, num_records),
+        "json_formatter": measure(json_format, JsonFormatter(SERVICE), num_records),
+        "json_formatter_epoch_ns": measure(json_format, JsonFormatter(SERVICE, "epoch_ns"), num_records)
+    }
+
+    baseline = results["legacy_template"]
+    for name, rate in results.items():
+        print(f"{name:<26} {rate:>12,.0f} records/s  x{rate / baseline:.2f}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Log formatter micro-benchmark")
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.records)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
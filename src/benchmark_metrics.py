@@ -0,0 +1,113 @@
+import argparse
+import json
+import tempfile
+import threading
+import time
+
+from metrics import MetricsCollector
+
+class LockedMetrics:
+    """Reference implementation of the previous single-lock storage"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {
+            "counters": {"transactions_total": {"value": 0}},
+            "gauges": {"active_requests": {"value": 0}},
+            "histograms": {
+                "transaction_duration_seconds": {
+                    "count": 0,
+                    "sum": 0,
+                    "buckets": {str(b): 0 for b in [0.1, 0.5, 1.0, 2.0, 5.0]}
+                }
+            }
+        }
+
+    def record_request(self, duration):
+        with self.lock:
+            self.metrics["gauges"]["active_requests"]["value"] += 1
+        with self.lock:
+            self.metrics["counters"]["transactions_total"]["value"] += 1
+        with self.lock:
+            metrics = self.metrics["histograms"]["transaction_duration_seconds"]
+            metrics["count"] += 1
+            metrics["sum"] += duration
+            for bucket in metrics["buckets"]:
+                if duration <= float(bucket):
+                    metrics["buckets"][bucket] += 1
+        with self.lock:
+            self.metrics["gauges"]["active_requests"]["value"] -= 1
+
+class ShardedMetrics:
+    """The same four updates per request against MetricsCollector"""
+    def __init__(self, metrics_dir):
+        self.collector = MetricsCollector("benchmark", metrics_dir=metrics_dir)
+        self.counter = self.collector.counter("transactions_total")
+        self.gauge = self.collector.gauge("active_requests")
+        self.histogram = self.collector.histogram("transaction_duration_seconds")
+
+    def record_request(self, duration):
+        self.gauge.inc()
+        self.counter.inc()
+        self.histogram.observe(duration)
+        self.gauge.dec()
+
+def run_contention(target, num_threads, requests_per_thread):
+    """Hammer target.record_request from num_threads threads, return updates/sec"""
+    barrier = threading.Barrier(num_threads + 1)
+    durations = [0.05, 0.3, 0.8, 1.5, 3.0, 7.0]
+
+    def worker():
+        barrier.wait()
+        for i in range(requests_per_thread):
+            target.record_request(durations[i % len(durations)])
+
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+
+    # Four metric updates per simulated request
+    return 4 * num_threads * requests_per_thread / elapsed
+
+def run_benchmark(thread_counts=(1, 2, 4, 8, 16), requests_per_thread=20000):
+    """Compare updates/sec of locked and sharded storage across thread counts"""
+    metrics_dir = tempfile.mkdtemp(prefix="metrics-bench-")
+    results = []
+
+    for num_threads in thread_counts:
+        locked = run_contention(LockedMetrics(), num_threads, requests_per_thread)
+        sharded_metrics = ShardedMetrics(metrics_dir)
+        sharded = run_contention(sharded_metrics, num_threads, requests_per_thread)
+
+        # Sanity check that no update was lost while merging shards
+        expected = num_threads * requests_per_thread
+        assert sharded_metrics.counter.get() == expected
+        assert sharded_metrics.gauge.get() == 0
+
+        results.append({
+            "threads": num_threads,
+            "locked_updates_per_sec": locked,
+            "sharded_updates_per_sec": sharded,
+            "speedup": sharded / locked
+        })
+        print(f"{num_threads:>3} threads: locked {locked:>12,.0f} updates/s | "
+              f"sharded {sharded:>12,.0f} updates/s | x{sharded / locked:.2f}")
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Metric storage contention benchmark")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=20000,
+                        help="Simulated requests per thread")
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.threads, args.requests)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,3 +1,5 @@
+import argparse
+import hashlib
 import json
 import matplotlib
 # Set the backend to Agg (non-interactive)
@@ -6,21 +8,165 @@ import matplotlib.pyplot as plt
 import time
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from log_index import parse_time_arg
+from multiprocess import collect
+from tsdb import TimeSeriesDB, metric_name, rate
+from persistence import atomic_write
+
+# Remembers the content hash and images of every panel between runs
+MANIFEST_FILE = ".dashboard_manifest.json"
+# Below this many changed panels a process pool costs more than it saves
+PARALLEL_THRESHOLD = 4
+
+def _series_label(labels):
+    return ",".join(str(value) for value in labels.values())
+
+def build_panels(metrics):
+    """Describe every dashboard panel as plain data: name, titles and bars"""
+    panels = []
+
+    for kind, title, ylabel in (("counters", "Counters", "Count"), ("gauges", "Gauges", "Value")):
+        entries = metrics.get(kind) or {}
+        if not entries:
+            continue
+        panels.append({
+            "name": kind,
+            "title": title,
+            "xlabel": "",
+            "ylabel": ylabel,
+            "labels": list(entries),
+            "values": [entry["value"] for entry in entries.values()],
+            "rotate": True
+        })
+        # One breakdown panel per labelled family
+        for name, entry in entries.items():
+            if entry.get("series"):
+                panels.append({
+                    "name": f"{kind[:-1]}_{name}",
+                    "title": f"{name} by {', '.join(entry['labels'])}",
+                    "xlabel": "",
+                    "ylabel": ylabel,
+                    "labels": [_series_label(series["labels"]) for series in entry["series"]],
+                    "values": [series["value"] for series in entry["series"]],
+                    "rotate": True
+                })
+
+    for name, hist in (metrics.get("histograms") or {}).items():
+        panels.append({
+            "name": f"histogram_{name}",
+            "title": f"Histogram: {name}",
+            "xlabel": "Bucket",
+            "ylabel": "Count",
+            "labels": list(hist["buckets"]),
+            "values": list(hist["buckets"].values()),
+            "rotate": False
+        })
+
+    for name, summary in (metrics.get("summaries") or {}).items():
+        quantiles = [q for q, v in summary["quantiles"].items() if v is not None]
+        panels.append({
+            "name": f"summary_{name}",
+            "title": f"Percentiles: {name} ({summary['count']} observations)",
+            "xlabel": "Percentile",
+            "ylabel": "Value",
+            "labels": [f"p{float(q) * 100:g}" for q in quantiles],
+            "values": [summary["quantiles"][q] for q in quantiles],
+            "rotate": False
+        })
+    return panels
+
+def panel_hash(panel):
+    return hashlib.sha1(json.dumps(panel, sort_keys=True).encode("utf-8")).hexdigest()
+
+_figure = None
+
+def _render(jobs):
+    """Render (panel, path) jobs, reusing one figure per process"""
+    global _figure
+    if _figure is None:
+        _figure = plt.figure(figsize=(10, 6))
+    rendered = []
+    for panel, path in jobs:
+        _figure.clf()
+        ax = _figure.add_subplot()
+        if panel.get("kind") == "line":
+            for label, points in panel["lines"].items():
+                ax.plot([datetime.fromtimestamp(ts) for ts, _ in points],
+                        [value for _, value in points], label=label)
+            if len(panel["lines"]) > 1:
+                ax.legend(fontsize="small")
+        else:
+            ax.bar(panel["labels"], panel["values"])
+        ax.set_title(panel["title"])
+        ax.set_xlabel(panel["xlabel"])
+        ax.set_ylabel(panel["ylabel"])
+        if panel["rotate"]:
+            ax.tick_params(axis="x", labelrotation=45)
+        _figure.tight_layout()
+        _figure.savefig(path)
+        rendered.append(path)
+    return rendered
+
+def _load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _evict(manifest, output_dir, keep, max_age):
+    """Delete images beyond the newest keep per panel or older than max_age seconds"""
+    removed = []
+    now = time.time()
+    for entry in manifest.values():
+        files = entry["files"]
+        expired = files[:-keep] if keep and len(files) > keep else []
+        if max_age is not None:
+            # Never evict the current image of a panel
+            expired += [name for name in files[:-1] if name not in expired
+                        and now - _mtime(os.path.join(output_dir, name)) > max_age]
+        for name in expired:
+            try:
+                os.remove(os.path.join(output_dir, name))
+            except FileNotFoundError:
+                pass
+            removed.append(name)
+        entry["files"] = [name for name in files if name not in expired]
+    return removed
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+def create_dashboard(metrics_file, output_dir="dashboards", multiprocess_dir=None, app_name="fintech-app",
+                     quiet=False, workers=None, keep=5, max_age=None, force=False):
+    """Create visualizations of metrics data.
+
+    Panels whose data hashes the same as on the previous run are skipped,
+    changed panels are rendered in a process pool when there are enough of
+    them, and only the newest keep images per panel (optionally younger than
+    max_age seconds) are kept. Returns {panel name: current image path}.
+    """
+    def log(message):
+        if not quiet:
+            print(message)
 
-def create_dashboard(metrics_file, output_dir="dashboards"):
-    """Create visualizations of metrics data"""
-    print(f"Creating dashboard from metrics file: {metrics_file}")
-    print(f"Output directory: {output_dir}")
-    
     os.makedirs(output_dir, exist_ok=True)
     
     # Load metrics data
     try:
-        print(f"Attempting to open metrics file...")
-        with open(metrics_file, "r") as f:
-            metrics = json.load(f)
-        print(f"Successfully loaded metrics data")
-        print(f"Metrics content: {json.dumps(metrics, indent=2)}")
+        if multiprocess_dir:
+            # Merge the per-worker files of a multi-process deployment
+            log(f"Merging worker metrics from: {multiprocess_dir}")
+            metrics = collect(multiprocess_dir, app_name)
+        else:
+            with open(metrics_file, "r") as f:
+                metrics = json.load(f)
     except FileNotFoundError:
         print(f"Error: Metrics file {metrics_file} not found")
         return
@@ -28,112 +174,175 @@ def create_dashboard(metrics_file, output_dir="dashboards"):
         print(f"Error: Metrics file {metrics_file} contains invalid JSON")
         return
     
+    panels = build_panels(metrics)
+    return render_panels(panels, output_dir, log, workers, keep, max_age, force)
+
+def render_panels(panels, output_dir, log=print, workers=None, keep=5, max_age=None, force=False):
+    """Render the changed panels, evict old images and return {panel name: current image path}"""
     # Create timestamp
     timestamp = time.strftime("%Y%m%d-%H%M%S")
-    print(f"Using timestamp: {timestamp}")
-    
-    # Plot counters
-    if "counters" in metrics and metrics["counters"]:
-        print(f"Generating counter plots...")
-        plt.figure(figsize=(10, 6))
-        counter_names = list(metrics["counters"].keys())
-        counter_values = [metrics["counters"][name]["value"] for name in counter_names]
-        
-        plt.bar(counter_names, counter_values)
-        plt.title("Counters")
-        plt.ylabel("Count")
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        
-        counter_file = f"{output_dir}/counters_{timestamp}.png"
-        print(f"Saving counter plot to: {counter_file}")
-        plt.savefig(counter_file)
-        plt.close()
-        
-        # Verify file was created
-        if os.path.exists(counter_file):
-            print(f"Successfully created counter plot: {counter_file}")
-            print(f"File size: {os.path.getsize(counter_file)} bytes")
-        else:
-            print(f"ERROR: Failed to create counter plot!")
-    else:
-        print("No counters found in metrics data")
-    
-    # Plot gauges
-    if "gauges" in metrics and metrics["gauges"]:
-        print(f"Generating gauge plots...")
-        plt.figure(figsize=(10, 6))
-        gauge_names = list(metrics["gauges"].keys())
-        gauge_values = [metrics["gauges"][name]["value"] for name in gauge_names]
-        
-        plt.bar(gauge_names, gauge_values)
-        plt.title("Gauges")
-        plt.ylabel("Value")
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        
-        gauge_file = f"{output_dir}/gauges_{timestamp}.png"
-        print(f"Saving gauge plot to: {gauge_file}")
-        plt.savefig(gauge_file)
-        plt.close()
-        
-        # Verify file was created
-        if os.path.exists(gauge_file):
-            print(f"Successfully created gauge plot: {gauge_file}")
-            print(f"File size: {os.path.getsize(gauge_file)} bytes")
-        else:
-            print(f"ERROR: Failed to create gauge plot!")
-    else:
-        print("No gauges found in metrics data")
-    
-    # Plot histograms
-    if "histograms" in metrics and metrics["histograms"]:
-        for name, hist in metrics["histograms"].items():
-            print(f"Generating histogram plot for: {name}")
-            plt.figure(figsize=(10, 6))
-            bucket_names = list(hist["buckets"].keys())
-            bucket_values = list(hist["buckets"].values())
-            
-            plt.bar(bucket_names, bucket_values)
-            plt.title(f"Histogram: {name}")
-            plt.xlabel("Bucket")
-            plt.ylabel("Count")
-            plt.tight_layout()
-            
-            hist_file = f"{output_dir}/histogram_{name}_{timestamp}.png"
-            print(f"Saving histogram plot to: {hist_file}")
-            plt.savefig(hist_file)
-            plt.close()
-            
-            # Verify file was created
-            if os.path.exists(hist_file):
-                print(f"Successfully created histogram plot: {hist_file}")
-                print(f"File size: {os.path.getsize(hist_file)} bytes")
+
+    manifest = _load_manifest(output_dir)
+    jobs = []
+    for panel in panels:
+        digest = panel_hash(panel)
+        entry = manifest.setdefault(panel["name"], {"hash": None, "files": []})
+        current = entry["files"][-1] if entry["files"] else None
+        if (not force and entry["hash"] == digest and current
+                and os.path.exists(os.path.join(output_dir, current))):
+            continue
+        filename = f"{panel['name']}_{timestamp}.png"
+        jobs.append((panel, os.path.join(output_dir, filename)))
+        entry["hash"] = digest
+        if filename not in entry["files"]:
+            entry["files"].append(filename)
+
+    log(f"{len(panels)} panels, {len(jobs)} changed")
+    if len(jobs) >= PARALLEL_THRESHOLD and workers != 1:
+        workers = min(workers or os.cpu_count() or 1, len(jobs))
+        # One chunk per worker so each process builds a single figure
+        chunks = [jobs[i::workers] for i in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for paths in pool.map(_render, chunks):
+                for path in paths:
+                    log(f"Rendered {path}")
+    elif jobs:
+        for path in _render(jobs):
+            log(f"Rendered {path}")
+
+    removed = _evict(manifest, output_dir, keep, max_age)
+    if removed:
+        log(f"Evicted {len(removed)} old images")
+    atomic_write(os.path.join(output_dir, MANIFEST_FILE), json.dumps(manifest, indent=2).encode("utf-8"))
+
+    log(f"Dashboard visualizations saved to {output_dir}/")
+    return {
+        name: os.path.join(output_dir, entry["files"][-1])
+        for name, entry in manifest.items() if entry["files"]
+    }
+
+def _sum_points(point_lists):
+    """Add several (ts, value) series point by point"""
+    totals = {}
+    for points in point_lists:
+        for ts, value in points:
+            totals[ts] = totals.get(ts, 0) + value
+    return sorted(totals.items())
+
+def _bucket_quantile(bucket_rates, count_rates, q):
+    """Upper bound of the bucket holding quantile q, per timestamp, from bucket rates.
+
+    Points where q falls beyond the largest finite bound are drawn at that
+    bound.
+    """
+    by_ts = {}
+    for bound, points in bucket_rates.items():
+        for ts, value in points:
+            by_ts.setdefault(ts, []).append((bound, value))
+    quantiles = []
+    for ts, buckets in sorted(by_ts.items()):
+        total = count_rates.get(ts, 0)
+        if total <= 0:
+            continue
+        buckets.sort()
+        bound = next((bound for bound, value in buckets if value >= q * total), buckets[-1][0])
+        quantiles.append((ts, bound))
+    return quantiles
+
+def build_history_panels(tsdb, start, end, max_points=500):
+    """Describe time-range panels: counter rates, gauges, histogram and summary latency"""
+    panels = []
+    for name, kind in sorted(tsdb.list_metrics().items()):
+        data = tsdb.query([name], start, end, max_points=max_points)
+        if not any(data.values()):
+            continue
+        lines = {}
+        if kind == "counters":
+            lines["total"] = _sum_points(rate(points) for points in data.values())
+            ylabel = "Per second"
+        elif kind == "gauges":
+            if len(data) <= 10:
+                lines = {series: points for series, points in data.items()}
             else:
-                print(f"ERROR: Failed to create histogram plot!")
-    else:
-        print("No histograms found in metrics data")
-    
-    print(f"Dashboard visualizations saved to {output_dir}/")
-    
-    # List all files in the output directory
-    print("Files in output directory:")
-    for file in os.listdir(output_dir):
-        file_path = os.path.join(output_dir, file)
-        print(f"  - {file} ({os.path.getsize(file_path)} bytes)")
+                lines["total"] = _sum_points(data.values())
+            ylabel = "Value"
+        elif kind == "histograms":
+            sums = _sum_points(rate(points) for series, points in data.items()
+                               if metric_name(series) == f"{name}_sum")
+            counts = dict(_sum_points(rate(points) for series, points in data.items()
+                                      if metric_name(series) == f"{name}_count"))
+            lines["mean"] = [(ts, value / counts[ts]) for ts, value in sums if counts.get(ts)]
+            # Bucket rates summed over label combinations, keyed by bound
+            bucket_rates = {}
+            for series, points in data.items():
+                if metric_name(series) == f"{name}_bucket":
+                    bound = float(series.rsplit('le="', 1)[1].split('"', 1)[0])
+                    bucket_rates.setdefault(bound, []).append(rate(points))
+            bucket_rates = {bound: _sum_points(lists) for bound, lists in bucket_rates.items()}
+            lines["p99 (bucket bound)"] = _bucket_quantile(bucket_rates, counts, 0.99)
+            ylabel = "Seconds"
+        else:
+            lines = {series: points for series, points in data.items() if 'quantile="' in series}
+            ylabel = "Value"
+        panels.append({
+            "name": f"history_{name}",
+            "kind": "line",
+            "title": f"{name} ({'rate' if kind == 'counters' else kind[:-1]})",
+            "xlabel": "Time",
+            "ylabel": ylabel,
+            "lines": {label: [list(point) for point in points] for label, points in lines.items()},
+            "rotate": True
+        })
+    return panels
+
+def create_history_dashboard(tsdb_dir, output_dir="dashboards", start=None, end=None,
+                             quiet=False, workers=None, keep=5, max_age=None, force=False):
+    """Plot rates and latency between start and end (default: the last hour).
+
+    The store picks the coarsest tier needed for the range, so the cost of
+    a query follows the range requested, not the total history kept.
+    """
+    def log(message):
+        if not quiet:
+            print(message)
+
+    os.makedirs(output_dir, exist_ok=True)
+    end = time.time() if end is None else end
+    start = end - 3600 if start is None else start
+    tsdb = TimeSeriesDB(tsdb_dir, readonly=True)
+    panels = build_history_panels(tsdb, start, end)
+    log(f"History from {time.ctime(start)} to {time.ctime(end)}")
+    return render_panels(panels, output_dir, log, workers, keep, max_age, force)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render metrics dashboards")
+    parser.add_argument("--quiet", action="store_true", help="Only print errors")
+    parser.add_argument("--workers", type=int, help="Render processes (default: CPU count)")
+    parser.add_argument("--keep", type=int, default=5, help="Images kept per panel (0 keeps all)")
+    parser.add_argument("--max-age", type=float, help="Also evict images older than this many seconds")
+    parser.add_argument("--force", action="store_true", help="Re-render unchanged panels")
+    parser.add_argument("--since", help="Plot history from the time-series store from this time: 5m, 2h, 1d or ISO datetime")
+    parser.add_argument("--until", help="End of the history range, same formats as --since")
+    args = parser.parse_args()
+
     # Use absolute path to find metrics file
     script_dir = os.path.dirname(os.path.abspath(__file__))
     base_dir = os.path.dirname(script_dir)
     metrics_path = os.path.join(base_dir, "metrics", "fintech-app_metrics.json")
     dashboards_dir = os.path.join(base_dir, "dashboards")
     
-    print(f"Script directory: {script_dir}")
-    print(f"Base directory: {base_dir}")
-    print(f"Metrics path: {metrics_path}")
-    print(f"Dashboards directory: {dashboards_dir}")
+    if not args.quiet:
+        print(f"Metrics path: {metrics_path}")
+        print(f"Dashboards directory: {dashboards_dir}")
     
+    if args.since:
+        create_history_dashboard(os.path.join(base_dir, "metrics", "tsdb"), dashboards_dir,
+                                 parse_time_arg(args.since),
+                                 parse_time_arg(args.until) if args.until else None,
+                                 quiet=args.quiet, workers=args.workers, keep=args.keep,
+                                 max_age=args.max_age, force=args.force)
+        sys.exit(0)
+
     # Check if file exists
     if not os.path.exists(metrics_path):
         print(f"Metrics file not found at: {metrics_path}")
@@ -158,6 +367,14 @@ if __name__ == "__main__":
                     "buckets": {"0.1": 5, "0.5": 15, "1.0": 20, "2.0": 8, "5.0": 2},
                     "description": "Transaction processing duration in seconds"
                 }
+            },
+            "summaries": {
+                "transaction_latency_seconds": {
+                    "count": 50,
+                    "sum": 45.2,
+                    "quantiles": {"0.5": 0.84, "0.95": 1.86, "0.99": 1.97},
+                    "description": "Transaction processing latency quantiles in seconds"
+                }
             }
         }
         
@@ -167,5 +384,9 @@ if __name__ == "__main__":
         
         print(f"Sample metrics file created at: {metrics_path}")
     
-    # Create dashboard using the metrics file
-    create_dashboard(metrics_path, dashboards_dir)
\ No newline at end of file
+    # Create dashboard using the metrics file, or the worker files if the
+    # app runs with several processes
+    create_dashboard(metrics_path, dashboards_dir,
+                     multiprocess_dir=os.environ.get("METRICS_MULTIPROC_DIR"),
+                     quiet=args.quiet, workers=args.workers, keep=args.keep,
+                     max_age=args.max_age, force=args.force)
\ No newline at end of file
@@ -0,0 +1,189 @@
+import json
+import math
+import threading
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+JSON_CONTENT_TYPE = "application/json"
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _escape_help(text):
+    return str(text).replace("\\", "\\\\").replace("\n", "\\n")
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels.items())
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+def _series(entry):
+    """Yield (labels, values) for every series of an exported metric entry"""
+    if "series" in entry:
+        for series in entry["series"]:
+            yield series["labels"], series
+    else:
+        yield {}, entry
+
+def iter_samples(snapshot):
+    """Yield (series id, value, cumulative) for every sample in a snapshot.
+
+    Series ids use the Prometheus sample notation, e.g.
+    'transactions_total{currency="USD"}' or 'lat_bucket{le="0.5"}'.
+    cumulative is True for values that only grow (counters, histogram and
+    summary counts/sums/buckets), which makes them safe to delta-encode.
+    """
+    for name, entry in snapshot.get("counters", {}).items():
+        for labels, values in _series(entry):
+            yield f"{name}{_format_labels(labels)}", values["value"], True
+
+    for name, entry in snapshot.get("gauges", {}).items():
+        for labels, values in _series(entry):
+            yield f"{name}{_format_labels(labels)}", values["value"], False
+
+    for name, entry in snapshot.get("histograms", {}).items():
+        for labels, values in _series(entry):
+            for bound, count in values["buckets"].items():
+                yield f"{name}_bucket{_format_labels(labels, ('le', bound))}", count, True
+            yield f"{name}_sum{_format_labels(labels)}", values["sum"], True
+            yield f"{name}_count{_format_labels(labels)}", values["count"], True
+
+    for name, entry in snapshot.get("summaries", {}).items():
+        for labels, values in _series(entry):
+            for quantile, value in values["quantiles"].items():
+                yield f"{name}{_format_labels(labels, ('quantile', quantile))}", value, False
+            yield f"{name}_sum{_format_labels(labels)}", values["sum"], True
+            yield f"{name}_count{_format_labels(labels)}", values["count"], True
+
+def render_prometheus(snapshot):
+    """Render a MetricsCollector snapshot in the Prometheus text format (0.0.4)"""
+    lines = []
+
+    def header(name, entry, metric_type):
+        if entry.get("description"):
+            lines.append(f"# HELP {name} {_escape_help(entry['description'])}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+    for name, entry in snapshot.get("counters", {}).items():
+        header(name, entry, "counter")
+        for labels, values in _series(entry):
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(values['value'])}")
+
+    for name, entry in snapshot.get("gauges", {}).items():
+        header(name, entry, "gauge")
+        for labels, values in _series(entry):
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(values['value'])}")
+
+    for name, entry in snapshot.get("histograms", {}).items():
+        header(name, entry, "histogram")
+        for labels, values in _series(entry):
+            for bound, count in values["buckets"].items():
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {values['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values['count']}")
+
+    for name, entry in snapshot.get("summaries", {}).items():
+        header(name, entry, "summary")
+        for labels, values in _series(entry):
+            for quantile, value in values["quantiles"].items():
+                lines.append(
+                    f"{name}{_format_labels(labels, ('quantile', quantile))} {_format_value(value)}"
+                )
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values['count']}")
+
+    return "\n".join(lines) + "\n"
+
+def render_json(snapshot):
+    return json.dumps(snapshot, separators=(",", ":"))
+
+class MetricsExporter:
+    """Serve rendered metrics from a collector, re-rendering only on change.
+
+    The rendered payload for each format is cached together with the
+    collector generation it was built from. A scrape only pays for a new
+    snapshot when some metric changed since the last rendering, so many
+    scrapers polling often cost about as much as one.
+    """
+    FORMATS = {
+        "prometheus": (render_prometheus, PROMETHEUS_CONTENT_TYPE),
+        "json": (render_json, JSON_CONTENT_TYPE)
+    }
+
+    def __init__(self, collector):
+        self.collector = collector
+        self._cache = {}
+        # Serializes rebuilds so concurrent scrapers do not all re-render
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """Return (generation, snapshot), reusing the cached snapshot if current"""
+        generation = self.collector.generation()
+        with self._lock:
+            cached = self._cache.get("snapshot")
+            if cached is None or cached[0] != generation:
+                # Read the generation before the snapshot so a concurrent
+                # update at worst causes one extra rebuild, never a stale hit
+                cached = (generation, self.collector.snapshot())
+                self._cache["snapshot"] = cached
+        return cached
+
+    def render(self, fmt="json"):
+        """Return (payload bytes, content type) for the given format"""
+        renderer, content_type = self.FORMATS[fmt]
+        generation = self.collector.generation()
+        cached = self._cache.get(fmt)
+        if cached is not None and cached[0] == generation:
+            return cached[1], content_type
+
+        snapshot_generation, snapshot = self.snapshot()
+        with self._lock:
+            cached = self._cache.get(fmt)
+            if cached is None or cached[0] != snapshot_generation:
+                cached = (snapshot_generation, renderer(snapshot).encode("utf-8"))
+                self._cache[fmt] = cached
+        return cached[1], content_type
+
+def negotiate_format(accept_header, requested=None):
+    """Pick "prometheus" or "json" from a ?format= override or an Accept header.
+
+    Prometheus scrapers send text/plain or application/openmetrics-text;
+    anything else (browsers, curl, existing JSON consumers) gets JSON.
+    """
+    if requested in MetricsExporter.FORMATS:
+        return requested
+    best, best_q = "json", 0.0
+    for part in (accept_header or "").split(","):
+        fields = part.strip().split(";")
+        media_type = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type in ("text/plain", "application/openmetrics-text"):
+            fmt = "prometheus"
+        elif media_type == "application/json":
+            fmt = "json"
+        else:
+            continue
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
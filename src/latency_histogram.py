@@ -0,0 +1,107 @@
+class LatencyHistogram:
+    """HDR-style latency histogram with fixed relative precision.
+
+    Durations are recorded as integer microseconds into log-linear buckets:
+    every power-of-two range is split into the same number of linear
+    sub-buckets, enough to keep significant_figures decimal digits. Recording
+    is a couple of integer operations, memory only grows with the number of
+    distinct buckets hit, and histograms with the same precision merge
+    exactly by adding their counts, so per-worker histograms can be combined
+    at the end of a run.
+    """
+
+    def __init__(self, significant_figures=3):
+        if not 1 <= significant_figures <= 5:
+            raise ValueError("significant_figures must be between 1 and 5")
+        self.significant_figures = significant_figures
+        # Smallest power of two that resolves 2 * 10^figures values linearly
+        self.sub_bucket_bits = (2 * 10 ** significant_figures - 1).bit_length()
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.counts = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (shift + 1) * self.sub_bucket_half + (value >> shift) - self.sub_bucket_half
+
+    def _highest_equivalent(self, index):
+        """Largest microsecond value that falls into bucket index"""
+        if index < self.sub_bucket_count:
+            return index
+        shift = index // self.sub_bucket_half - 1
+        sub_bucket = index % self.sub_bucket_half + self.sub_bucket_half
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Record a single duration in seconds"""
+        value = max(0, int(seconds * 1e6))
+        index = self._index(value)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return the duration in seconds at percentile p (0-100)"""
+        if self.count == 0:
+            return None
+        if p <= 0:
+            return self.min / 1e6
+        if p >= 100:
+            return self.max / 1e6
+        # Same rank convention as HdrHistogram: the value at or below which p% of records fall
+        rank = max(1, int(p / 100 * self.count + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest_equivalent(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        return self.sum / self.count / 1e6 if self.count else None
+
+    def merge(self, other):
+        """Add the contents of another histogram with the same precision to this one"""
+        if other.significant_figures != self.significant_figures:
+            raise ValueError("Cannot merge histograms with different significant_figures")
+        if other.count == 0:
+            return
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def to_dict(self):
+        """Serialize to a JSON-compatible dict"""
+        return {
+            "significant_figures": self.significant_figures,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "counts": {str(index): count for index, count in self.counts.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a histogram serialized with to_dict"""
+        histogram = cls(data["significant_figures"])
+        histogram.counts = {int(index): count for index, count in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from collections import deque
+
+from exposition import iter_samples
+
+SSE_CONTENT_TYPE = "text/event-stream"
+
+def _event(seq, name, data):
+    """Encode one Server-Sent Event"""
+    payload = json.dumps(data, separators=(",", ":"))
+    return f"id: {seq}\nevent: {name}\ndata: {payload}\n\n".encode("utf-8")
+
+class MetricsStream:
+    """Push metric changes to any number of Server-Sent Events viewers.
+
+    A single producer thread polls the exporter once per interval. When the
+    collector generation changed it diffs the flattened samples against the
+    previous tick and encodes one "delta" event with the changed series
+    (plus a "snapshot" event with the full state for new viewers). Viewers
+    only wait on a shared Condition and write the already-encoded bytes, so
+    fifty open dashboards cost about as much as one. The last history
+    events are kept so a slow or reconnecting viewer (Last-Event-ID) gets
+    the deltas it missed, or the full snapshot if it fell further behind.
+    """
+
+    def __init__(self, exporter, interval=1.0, history=64, keepalive=15.0):
+        self.exporter = exporter
+        self.interval = interval
+        self.keepalive = keepalive
+        self._condition = threading.Condition()
+        # (seq, encoded delta event) for the last history ticks
+        self._events = deque(maxlen=history)
+        # (seq, encoded snapshot event) of the latest tick
+        self._snapshot = None
+        self._seq = 0
+        self._values = {}
+        self._generation = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.viewers = 0
+
+    def _ensure_started(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-stream")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"Error streaming metrics: {e}")
+            self._stop_event.wait(self.interval)
+
+    def _tick(self):
+        """Publish the changes since the previous tick; return False if there were none"""
+        generation, snapshot = self.exporter.snapshot()
+        if generation == self._generation:
+            return False
+        self._generation = generation
+
+        values = {series: value for series, value, _ in iter_samples(snapshot)}
+        changed = {series: value for series, value in values.items()
+                   if series not in self._values or self._values[series] != value}
+        removed = [series for series in self._values if series not in values]
+        self._values = values
+        if not changed and not removed:
+            return False
+
+        now = time.time()
+        with self._condition:
+            self._seq += 1
+            self._events.append((self._seq, _event(self._seq, "delta",
+                                                   {"ts": now, "set": changed, "removed": removed})))
+            self._snapshot = (self._seq, _event(self._seq, "snapshot",
+                                                {"ts": now, "set": values, "removed": []}))
+            self._condition.notify_all()
+        return True
+
+    def subscribe(self, last_event_id=None):
+        """Yield encoded SSE events for one viewer until it disconnects"""
+        self._ensure_started()
+        with self._condition:
+            self.viewers += 1
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            if last_event_id is not None and oldest - 1 <= last_event_id <= self._seq:
+                # Reconnect: the viewer still has its state, resume with deltas
+                seq, first = last_event_id, None
+            elif self._snapshot is not None:
+                seq, first = self._snapshot
+            else:
+                seq, first = 0, None
+        try:
+            # Browsers reconnect after this many milliseconds
+            yield b"retry: 2000\n\n"
+            if first is not None:
+                yield first
+            while not self._stop_event.is_set():
+                with self._condition:
+                    if self._seq == seq:
+                        self._condition.wait(self.keepalive)
+                    if self._seq == seq:
+                        pending = None
+                    elif seq + 1 < self._events[0][0]:
+                        # Fell behind the kept history: resend the full state
+                        pending = [self._snapshot[1]]
+                    else:
+                        pending = [event for event_seq, event in self._events if event_seq > seq]
+                    seq = self._seq
+                if pending is None:
+                    # Comment line so proxies keep an idle connection open
+                    yield b": keepalive\n\n"
+                else:
+                    yield from pending
+        finally:
+            with self._condition:
+                self.viewers -= 1
+
+    def stop(self):
+        """Stop the producer and end every open stream"""
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
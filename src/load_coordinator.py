@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener, wait
+
+from async_load import AsyncLoadTest
+from latency_histogram import LatencyHistogram
+from simulate_load import ResultRecorder, summarize_results
+
+# Port 0 lets the OS pick a free port for local-only runs
+DEFAULT_ADDRESS = ("127.0.0.1", 0)
+# Seconds between the partial histograms a worker streams back
+REPORT_INTERVAL = 1.0
+
+def split_load(total, parts):
+    """Split an integer load into parts that differ by at most one"""
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+def _report(histogram, total, successful, done=False):
+    return {"type": "done" if done else "progress", "total": total,
+            "successful": successful, "latency": histogram.to_dict()}
+
+async def _run_job(connection, job):
+    """Run one slice of the load test, streaming histogram deltas to the coordinator"""
+    recorder = ResultRecorder(job["worker"])
+    interval = {"histogram": LatencyHistogram(), "total": 0, "successful": 0}
+
+    def on_result(result):
+        recorder.record(result)
+        interval["total"] += 1
+        if result.get("success", False):
+            interval["successful"] += 1
+        if "duration" in result:
+            interval["histogram"].record(result["duration"])
+
+    def send(done=False):
+        connection.send(_report(interval["histogram"], interval["total"],
+                                interval["successful"], done))
+        interval.update(histogram=LatencyHistogram(), total=0, successful=0)
+
+    test = AsyncLoadTest(job["server_url"], mode=job["mode"], users=job["users"], rps=job["rps"],
+                         duration=job["duration"], transactions_per_user=job["transactions_per_user"],
+                         connections=job["connections"], on_result=on_result)
+    load = asyncio.ensure_future(test.run_async())
+    try:
+        while not load.done():
+            await asyncio.wait([load], timeout=REPORT_INTERVAL)
+            if not load.done():
+                send()
+        await load
+    finally:
+        recorder.close()
+    send(done=True)
+
+def worker_main(address, authkey):
+    """Connect to a coordinator, run the job it hands out and report back"""
+    with Client(address, authkey=authkey) as connection:
+        job = connection.recv()
+        asyncio.run(_run_job(connection, job))
+
+class LoadCoordinator:
+    """Spread one load test over several processes and merge their results.
+
+    The coordinator listens on a local socket (multiprocessing.connection,
+    authenticated with authkey), forks local_workers processes and optionally
+    waits for remote_workers started elsewhere with
+    `python src/load_coordinator.py worker --connect HOST:PORT --authkey KEY`.
+    Each worker runs the asyncio engine on its slice of the users (closed
+    mode) or of the arrival rate (open mode) and streams a LatencyHistogram
+    and counters every REPORT_INTERVAL seconds. The coordinator merges them
+    as they arrive, so load generation scales with cores instead of one GIL.
+    """
+
+    def __init__(self, server_url="http://localhost:5000", local_workers=None, remote_workers=0,
+                 address=DEFAULT_ADDRESS, authkey=None, connect_timeout=30):
+        self.server_url = server_url
+        self.local_workers = (os.cpu_count() or 1) if local_workers is None else local_workers
+        self.remote_workers = remote_workers
+        self.address = address
+        self.authkey = authkey or os.urandom(16)
+        self.connect_timeout = connect_timeout
+        self.histogram = LatencyHistogram()
+        self.total = 0
+        self.successful = 0
+
+    def _merge(self, report):
+        self.histogram.merge(LatencyHistogram.from_dict(report["latency"]))
+        self.total += report["total"]
+        self.successful += report["successful"]
+
+    def _accept(self, listener, count):
+        # Listener.accept has no timeout, so accept on a helper thread
+        connections = []
+
+        def accept():
+            while len(connections) < count:
+                connections.append(listener.accept())
+
+        thread = threading.Thread(target=accept, name="load-coordinator-accept", daemon=True)
+        thread.start()
+        thread.join(self.connect_timeout)
+        if thread.is_alive():
+            for connection in connections:
+                connection.close()
+            raise TimeoutError(f"Only {len(connections)} of {count} workers connected")
+        return connections
+
+    def run(self, mode="closed", users=50, rps=50.0, duration=30.0,
+            transactions_per_user=None, connections=100):
+        """Run the test across all workers and return the merged summary"""
+        num_workers = self.local_workers + self.remote_workers
+        if num_workers < 1:
+            raise ValueError("At least one worker is required")
+
+        with Listener(self.address, authkey=self.authkey) as listener:
+            processes = [
+                multiprocessing.Process(target=worker_main, args=(listener.address, self.authkey),
+                                        name=f"load-worker-{i}", daemon=True)
+                for i in range(self.local_workers)
+            ]
+            for process in processes:
+                process.start()
+            if self.remote_workers:
+                print(f"Waiting for {self.remote_workers} remote workers on "
+                      f"{listener.address[0]}:{listener.address[1]}")
+            workers = self._accept(listener, num_workers)
+            # Throughput is measured from dispatch, not from process start-up
+            start_time = time.monotonic()
+
+            user_slices = split_load(users, num_workers)
+            connection_slices = split_load(max(connections, num_workers), num_workers)
+            for i, connection in enumerate(workers):
+                connection.send({
+                    "worker": f"worker_{i}",
+                    "server_url": self.server_url,
+                    "mode": mode,
+                    "users": user_slices[i],
+                    "rps": rps / num_workers,
+                    "duration": duration,
+                    "transactions_per_user": transactions_per_user,
+                    "connections": connection_slices[i]
+                })
+
+            pending = set(workers)
+            failed = 0
+            while pending:
+                for connection in wait(list(pending)):
+                    try:
+                        report = connection.recv()
+                    except EOFError:
+                        # Worker died; keep what it streamed before
+                        failed += 1
+                        pending.discard(connection)
+                        connection.close()
+                        continue
+                    self._merge(report)
+                    if report["type"] == "done":
+                        pending.discard(connection)
+                        connection.close()
+                print(f"\r{self.total} transactions, "
+                      f"p99 {self.histogram.percentile(99) or 0:.4f}s", end="", flush=True)
+            print()
+
+            for process in processes:
+                process.join()
+
+        elapsed = time.monotonic() - start_time
+        return summarize_results(self.histogram, self.total, self.successful, extra={
+            "engine": "processes",
+            "mode": mode,
+            "workers": num_workers,
+            "failed_workers": failed,
+            "users": users if mode == "closed" else None,
+            "target_rps": rps if mode == "open" else None,
+            "achieved_rps": self.total / elapsed if elapsed else 0
+        })
+
+def _parse_address(value):
+    host, _, port = value.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed load generation")
+    subparsers = parser.add_subparsers(dest="role")
+
+    run_parser = subparsers.add_parser("run", help="Coordinate a load test")
+    run_parser.add_argument("--url", default="http://localhost:5000")
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Local worker processes")
+    run_parser.add_argument("--remote-workers", type=int, default=0, help="Remote workers to wait for")
+    run_parser.add_argument("--listen", default="127.0.0.1:6000", help="Coordinator address")
+    run_parser.add_argument("--authkey", help="Shared secret (required with remote workers)")
+    run_parser.add_argument("--connect-timeout", type=float, default=60.0,
+                            help="Seconds to wait for all workers to connect")
+    run_parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    run_parser.add_argument("--users", type=int, default=50)
+    run_parser.add_argument("--rps", type=float, default=50.0)
+    run_parser.add_argument("--duration", type=float, default=30.0)
+    run_parser.add_argument("--transactions", type=int)
+    run_parser.add_argument("--connections", type=int, default=100, help="Total keep-alive connections")
+
+    worker_parser = subparsers.add_parser("worker", help="Join a coordinator as a remote worker")
+    worker_parser.add_argument("--connect", default="127.0.0.1:6000")
+    worker_parser.add_argument("--authkey", required=True)
+    args = parser.parse_args()
+
+    if args.role == "worker":
+        worker_main(_parse_address(args.connect), args.authkey.encode("utf-8"))
+    elif args.role == "run":
+        if args.remote_workers and not args.authkey:
+            parser.error("--remote-workers requires --authkey")
+        coordinator = LoadCoordinator(args.url, args.workers, args.remote_workers,
+                                      _parse_address(args.listen),
+                                      args.authkey.encode("utf-8") if args.authkey else None,
+                                      args.connect_timeout)
+        coordinator.run(args.mode, args.users, args.rps, args.duration,
+                        args.transactions, args.connections)
+    else:
+        parser.print_help()
@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+from async_load import AsyncLoadTest, HTTPConnectionPool
+from simulate_load import RESULTS_DIR, ResultRecorder
+
+DEFAULT_CONFIG = "load_tests/scenarios.json"
+DEFAULT_SLO = {"p99": 2.5, "error_rate": 0.01}
+PROFILE_TYPES = ("ramp", "step", "spike", "soak", "search")
+
+def expand_profile(profile):
+    """Turn a scenario profile into a list of (rps, duration) steps"""
+    kind = profile["type"]
+    if kind == "ramp":
+        steps = profile.get("steps", 10)
+        width = (profile["end_rps"] - profile["start_rps"]) / max(steps - 1, 1)
+        return [(profile["start_rps"] + width * i, profile["step_duration"]) for i in range(steps)]
+    if kind == "step":
+        return [(rps, profile["step_duration"]) for rps in profile["rps"]]
+    if kind == "spike":
+        # Baseline, the spike itself, then the same baseline to watch recovery
+        return [(profile["base_rps"], profile["base_duration"]),
+                (profile["spike_rps"], profile["spike_duration"]),
+                (profile["base_rps"], profile["base_duration"])]
+    if kind == "soak":
+        return [(profile["rps"], profile["duration"])]
+    raise ValueError(f"Profile type must be one of {PROFILE_TYPES}")
+
+async def _scrape(pool):
+    """Fetch the server's metrics as JSON, or None if they are unavailable"""
+    try:
+        status, body = await pool.request("GET", "/metrics?format=json")
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+        return None
+    if status != 200:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+def _histogram_delta(before, after, name):
+    """Server-side view of one histogram between two scrapes"""
+    if before is None or after is None:
+        return None
+    start = before.get("histograms", {}).get(name)
+    end = after.get("histograms", {}).get(name)
+    if end is None:
+        return None
+    start = start or {"count": 0, "sum": 0, "buckets": {}}
+    count = end["count"] - start["count"]
+    if count <= 0:
+        return {"count": 0, "mean": None, "p99_le": None}
+
+    # Cumulative buckets: the first bound holding 99% of the step's observations
+    p99_le = "+Inf"
+    for bound, cumulative in end["buckets"].items():
+        if cumulative - start["buckets"].get(bound, 0) >= 0.99 * count:
+            p99_le = float(bound)
+            break
+    return {"count": count, "mean": (end["sum"] - start["sum"]) / count, "p99_le": p99_le}
+
+def _gauge_value(snapshot, name):
+    if snapshot is None:
+        return None
+    gauge = snapshot.get("gauges", {}).get(name)
+    return gauge["value"] if gauge is not None else None
+
+async def run_step(server_url, rps, duration, label, slo, connections=100, scrape_interval=1.0):
+    """Offer rps requests/sec for duration seconds and report client and server stats"""
+    recorder = ResultRecorder(label)
+    test = AsyncLoadTest(server_url, mode="open", rps=rps, duration=duration,
+                         connections=connections, on_result=recorder.record)
+    metrics_pool = HTTPConnectionPool(server_url, max_connections=1, timeout=5)
+    active = []
+    try:
+        before = await _scrape(metrics_pool)
+        load = asyncio.ensure_future(test.run_async())
+        while not load.done():
+            await asyncio.wait([load], timeout=scrape_interval)
+            value = _gauge_value(await _scrape(metrics_pool), "active_requests")
+            if value is not None:
+                active.append(value)
+        await load
+        after = await _scrape(metrics_pool)
+    finally:
+        metrics_pool.close()
+        recorder.close()
+
+    histogram = recorder.histogram
+    error_rate = 1 - recorder.successful / recorder.total if recorder.total else 0
+    p99 = histogram.percentile(99)
+    step = {
+        "label": label,
+        "offered_rps": rps,
+        "duration": duration,
+        "requests": recorder.total,
+        "throughput": recorder.successful / test.elapsed if test.elapsed else 0,
+        "error_rate": error_rate,
+        "p50": histogram.percentile(50),
+        "p90": histogram.percentile(90),
+        "p99": p99,
+        "p99_9": histogram.percentile(99.9),
+        "max": histogram.percentile(100),
+        "active_requests": {
+            "mean": sum(active) / len(active) if active else None,
+            "max": max(active) if active else None
+        },
+        "server_duration": _histogram_delta(before, after, "transaction_duration_seconds")
+    }
+    step["slo_ok"] = (recorder.total > 0 and error_rate <= slo["error_rate"]
+                      and p99 is not None and p99 <= slo["p99"])
+    return step
+
+def _print_step(step):
+    server = step["server_duration"] or {}
+    active = step["active_requests"]
+    print(f"{step['label']:<28} offered {step['offered_rps']:>7.1f}/s  "
+          f"ok {step['throughput']:>7.1f}/s  err {step['error_rate']:>6.2%}  "
+          f"p99 {step['p99'] or 0:>7.3f}s  server p99<= {server.get('p99_le')}  "
+          f"active max {active['max']}  {'PASS' if step['slo_ok'] else 'FAIL'}")
+
+async def _run_profile(name, profile, server_url, slo, connections):
+    steps = []
+    for i, (rps, duration) in enumerate(expand_profile(profile)):
+        step = await run_step(server_url, rps, duration, f"{name}_step_{i}", slo, connections)
+        _print_step(step)
+        steps.append(step)
+    return steps
+
+async def _search(name, profile, server_url, slo, connections):
+    """Raise offered load geometrically until the SLO breaks, then bisect"""
+    steps = []
+    duration = profile["step_duration"]
+    factor = profile.get("factor", 1.5)
+    max_rps = profile.get("max_rps", 10000)
+
+    async def probe(rps):
+        step = await run_step(server_url, rps, duration, f"{name}_step_{len(steps)}", slo, connections)
+        _print_step(step)
+        steps.append(step)
+        return step["slo_ok"]
+
+    good, bad = None, None
+    rps = profile["start_rps"]
+    while rps <= max_rps:
+        if not await probe(rps):
+            bad = rps
+            break
+        good = rps
+        rps *= factor
+    if good is not None and bad is not None:
+        for _ in range(profile.get("refine", 3)):
+            middle = (good + bad) / 2
+            if await probe(middle):
+                good = middle
+            else:
+                bad = middle
+    return steps
+
+def run_scenario(name, profile, server_url="http://localhost:5000", slo=None, connections=100):
+    """Run one scenario and save its report to load_tests/results/scenario_<name>.json"""
+    slo = {**DEFAULT_SLO, **(slo or {}), **profile.get("slo", {})}
+    print(f"Scenario {name} ({profile['type']}), SLO p99 <= {slo['p99']}s, "
+          f"errors <= {slo['error_rate']:.2%}")
+    runner = _search if profile["type"] == "search" else _run_profile
+    steps = asyncio.run(runner(name, profile, server_url, slo, connections))
+
+    passing = [step for step in steps if step["slo_ok"]]
+    best = max(passing, key=lambda step: step["throughput"]) if passing else None
+    breached = next((step for step in steps if not step["slo_ok"]), None)
+    report = {
+        "scenario": name,
+        "profile": profile,
+        "slo": slo,
+        # Highest successful throughput of any step that met the SLO
+        "max_sustainable_throughput": best["throughput"] if best else 0,
+        "max_sustainable_offered_rps": best["offered_rps"] if best else 0,
+        "first_breach": breached["label"] if breached else None,
+        "steps": steps,
+        "timestamp": datetime.now().isoformat()
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, f"scenario_{name}.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Scenario {name}: max sustainable throughput "
+          f"{report['max_sustainable_throughput']:.1f} req/s"
+          + (f", SLO first breached at {report['first_breach']}" if breached else ""))
+    return report
+
+def load_config(path=DEFAULT_CONFIG):
+    with open(path, "r") as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run load profiles and find breaking points")
+    parser.add_argument("scenarios", nargs="*", help="Scenario names (default: all)")
+    parser.add_argument("--config", default=DEFAULT_CONFIG)
+    parser.add_argument("--url", help="Overrides server_url from the config")
+    parser.add_argument("--connections", type=int, default=100, help="Keep-alive connection pool size")
+    parser.add_argument("--list", action="store_true", help="List the configured scenarios and exit")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    scenarios = config["scenarios"]
+    if args.list:
+        for name, profile in scenarios.items():
+            print(f"{name:<20} {profile['type']}")
+        raise SystemExit(0)
+
+    names = args.scenarios or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    server_url = args.url or config.get("server_url", "http://localhost:5000")
+    start_time = time.monotonic()
+    for name in names:
+        run_scenario(name, scenarios[name], server_url, config.get("slo"), args.connections)
+    print(f"Finished {len(names)} scenarios in {time.monotonic() - start_time:.0f}s")
@@ -0,0 +1,227 @@
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from persistence import atomic_write
+
+try:
+    import zstandard
+except ImportError:  # gzip is used instead
+    zstandard = None
+
+# File suffix of each compression format
+COMPRESSION_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+def default_compression():
+    return "zstd" if zstandard is not None else "gzip"
+
+def manifest_path(archive_dir, base):
+    return os.path.join(archive_dir, f"{base}.manifest.json")
+
+def read_manifest(archive_dir, base):
+    """Return the archived segments of one log file, oldest first"""
+    try:
+        with open(manifest_path(archive_dir, base), "r") as f:
+            segments = json.load(f)["segments"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return []
+    return sorted(segments, key=lambda segment: segment["first_ts"] or 0)
+
+def open_segment(path):
+    """Open an archived segment for reading lines, decompressing as it streams"""
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd compressed; install zstandard to read it")
+        f = open(path, "rb")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def _compress(source, compression):
+    """Compress source next to itself and return the compressed path"""
+    target = source + COMPRESSION_SUFFIXES[compression]
+    tmp_path = target + ".tmp"
+    with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+        if compression == "zstd":
+            zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+        else:
+            with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=6) as gz:
+                shutil.copyfileobj(src, gz, 1 << 20)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, target)
+    return target
+
+def _scan_time_range(path):
+    """(first, last) record timestamps of a segment whose range was not tracked"""
+    # Imported here: log_index imports this module to read the archive
+    from log_index import parse_timestamp
+    first = last = None
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                ts = parse_timestamp(json.loads(line)["timestamp"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            first = ts if first is None else min(first, ts)
+            last = ts if last is None else max(last, ts)
+    return first, last
+
+class ArchivingFileHandler(RotatingFileHandler):
+    """Log file handler that rotates by size or age and archives compressed segments.
+
+    When the file reaches max_bytes or has been open for interval seconds it
+    is renamed into archive_dir (default <log dir>/archive) under the start
+    time of its first record, and a background thread compresses it with
+    zstd (if zstandard is installed) or gzip. The segments are listed in
+    <archive_dir>/<file>.manifest.json with their first and last record
+    timestamps, so queries only decompress the segments that overlap the
+    requested time window. Segments older than retention_days are deleted;
+    by default they are kept forever.
+    """
+    _STOP = object()
+
+    def __init__(self, filename, max_bytes=10485760, interval=86400, archive_dir=None,
+                 compression=None, retention_days=None, encoding=None):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=0, encoding=encoding)
+        self.interval = interval
+        self.archive_dir = archive_dir or os.path.join(os.path.dirname(self.baseFilename), "archive")
+        self.compression = compression or default_compression()
+        if self.compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"compression must be one of {tuple(COMPRESSION_SUFFIXES)}")
+        if self.compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.retention_days = retention_days
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.base = os.path.basename(self.baseFilename)
+        self.manifest_path = manifest_path(self.archive_dir, self.base)
+
+        # Time range of the records in the current file; unknown for a file
+        # left by an earlier run, which is then scanned when archived
+        self.first_ts = None
+        self.last_ts = None
+        self.rollover_at = time.time() + interval if interval else None
+        self._manifest_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._compressor = threading.Thread(target=self._run, name=f"log-archiver-{self.base}")
+        self._compressor.daemon = True
+        self._compressor.start()
+
+        # Segments archived but not compressed when the last run stopped
+        for segment in read_manifest(self.archive_dir, self.base):
+            if segment.get("compression") is None:
+                self._queue.put(segment["file"])
+
+    def rollover_due(self, length):
+        """True if writing length more bytes should start a new segment"""
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes > 0 and self.stream.tell() + length >= self.maxBytes:
+            return True
+        return self.rollover_at is not None and time.time() >= self.rollover_at
+
+    def shouldRollover(self, record):
+        return self.rollover_due(len(self.format(record) + self.terminator))
+
+    def track(self, created):
+        """Widen the current segment's time range to include a written record"""
+        if self.first_ts is None or created < self.first_ts:
+            self.first_ts = created
+        if self.last_ts is None or created > self.last_ts:
+            self.last_ts = created
+
+    def emit(self, record):
+        super().emit(record)
+        self.track(record.created)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(self.first_ts or time.time()))
+            name = f"{self.base}.{stamp}"
+            number = 0
+            while any(os.path.exists(os.path.join(self.archive_dir, candidate))
+                      for candidate in [name] + [name + suffix for suffix in COMPRESSION_SUFFIXES.values()]):
+                number += 1
+                name = f"{self.base}.{stamp}.{number}"
+            os.replace(self.baseFilename, os.path.join(self.archive_dir, name))
+            self._update_manifest([name], {
+                "file": name,
+                "first_ts": self.first_ts,
+                "last_ts": self.last_ts,
+                "bytes": os.path.getsize(os.path.join(self.archive_dir, name)),
+                "compression": None
+            })
+            self._queue.put(name)
+        self.first_ts = None
+        self.last_ts = None
+
+        if not self.delay:
+            self.stream = self._open()
+
+    def _update_manifest(self, names, segment=None):
+        """Drop the manifest entries for names and add segment, if given"""
+        with self._manifest_lock:
+            segments = [entry for entry in read_manifest(self.archive_dir, self.base)
+                        if entry["file"] not in names]
+            if segment is not None:
+                segments.append(segment)
+            atomic_write(self.manifest_path, json.dumps({"segments": segments}, indent=2).encode("utf-8"))
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            if name is self._STOP:
+                return
+            try:
+                self._archive(name)
+                self._expire()
+            except Exception as e:
+                print(f"Error archiving log segment {name}: {e}")
+
+    def _archive(self, name):
+        source = os.path.join(self.archive_dir, name)
+        if not os.path.exists(source):
+            return
+        segment = next((entry for entry in read_manifest(self.archive_dir, self.base)
+                        if entry["file"] == name), None) or {"file": name, "bytes": os.path.getsize(source)}
+        if segment.get("first_ts") is None:
+            segment["first_ts"], segment["last_ts"] = _scan_time_range(source)
+        target = _compress(source, self.compression)
+        compressed = os.path.basename(target)
+        segment.update(file=compressed, compression=self.compression,
+                       compressed_bytes=os.path.getsize(target))
+        self._update_manifest([name, compressed], segment)
+        # The manifest points at the compressed file before the original goes away
+        os.remove(source)
+
+    def _expire(self):
+        if not self.retention_days:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        for segment in read_manifest(self.archive_dir, self.base):
+            if segment.get("compression") and segment["last_ts"] is not None and segment["last_ts"] < cutoff:
+                self._update_manifest([segment["file"]])
+                try:
+                    os.remove(os.path.join(self.archive_dir, segment["file"]))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """Close the file and wait for queued segments to be compressed"""
+        if self._compressor.is_alive():
+            self._queue.put(self._STOP)
+            self._compressor.join()
+        super().close()
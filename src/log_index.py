@@ -0,0 +1,377 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+from log_archive import COMPRESSION_SUFFIXES, open_segment, read_manifest
+from persistence import atomic_write
+
+# Bytes hashed to identify a segment. The start of a log file never changes
+# once written, so the identity survives RotatingFileHandler renaming
+# app.log to app.log.1 and the index built so far is reused.
+FINGERPRINT_BYTES = 4096
+# One (timestamp, offset) entry per this many records in the sparse time index
+TIME_INDEX_STRIDE = 32
+# Records from concurrent threads can land slightly out of time order, so
+# time range lookups widen the scanned byte range by this many seconds
+CLOCK_SLACK = 1.0
+
+def _fingerprint(path):
+    with open(path, "rb") as f:
+        head = f.read(FINGERPRINT_BYTES)
+    # Only hash complete lines so a file still being written keeps its identity
+    if len(head) == FINGERPRINT_BYTES:
+        head = head[:head.rfind(b"\n") + 1]
+    return hashlib.sha1(head).hexdigest() if head else None
+
+_second_cache = {}
+
+def parse_timestamp(value):
+    """Convert a record timestamp (asctime string or epoch ns) to epoch seconds"""
+    if isinstance(value, (int, float)):
+        return value / 1e9
+    prefix, _, millis = value.partition(",")
+    seconds = _second_cache.get(prefix)
+    if seconds is None:
+        seconds = time.mktime(time.strptime(prefix, "%Y-%m-%d %H:%M:%S"))
+        if len(_second_cache) > 4096:
+            _second_cache.clear()
+        _second_cache[prefix] = seconds
+    return seconds + (int(millis) / 1000 if millis else 0)
+
+def parse_time_arg(value, now=None):
+    """Parse '5m', '2h', '30s', '1d' (relative to now) or an ISO datetime"""
+    now = time.time() if now is None else now
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if match:
+        unit = {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return now - float(match.group(1)) * unit
+    return datetime.fromisoformat(value).timestamp()
+
+class SegmentIndex:
+    """Index of one log segment: transaction ids, levels and a sparse time index.
+
+    All positions are byte offsets of record starts in the segment, so a
+    lookup seeks straight to the matching lines.
+    """
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.indexed_bytes = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.records = 0
+        self.txn = {}
+        self.levels = {}
+        self.times = []
+
+    def update(self, path):
+        """Index the records appended to path since the last update"""
+        with open(path, "rb") as f:
+            f.seek(self.indexed_bytes)
+            offset = self.indexed_bytes
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Partially written record; index it next time
+                    break
+                self._add(line, offset)
+                offset += len(line)
+        changed = offset != self.indexed_bytes
+        self.indexed_bytes = offset
+        return changed
+
+    def _add(self, line, offset):
+        try:
+            record = json.loads(line)
+            ts = parse_timestamp(record["timestamp"])
+        except (ValueError, KeyError, TypeError):
+            return
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+
+        self.levels.setdefault(record.get("level", ""), []).append(offset)
+        message = record.get("message")
+        if isinstance(message, dict) and message.get("transaction_id") is not None:
+            self.txn.setdefault(str(message["transaction_id"]), []).append(offset)
+        if self.records % TIME_INDEX_STRIDE == 0:
+            self.times.append((ts, offset))
+        self.records += 1
+
+    def offset_range(self, since=None, until=None):
+        """Return (start, end) byte offsets that contain every record in [since, until]"""
+        start, end = 0, self.indexed_bytes
+        if since is not None and self.times:
+            # Last sampled record before since; records are (nearly) in time order
+            i = bisect_left(self.times, (since - CLOCK_SLACK, -1)) - 1
+            start = self.times[i][1] if i >= 0 else 0
+        if until is not None and self.times:
+            i = bisect_right(self.times, (until + CLOCK_SLACK, float("inf")))
+            if i < len(self.times):
+                end = self.times[i][1]
+        return start, end
+
+    def to_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "indexed_bytes": self.indexed_bytes,
+            "first_ts": self.first_ts,
+            "last_ts": self.last_ts,
+            "records": self.records,
+            "txn": self.txn,
+            "levels": self.levels,
+            "times": self.times
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(data["fingerprint"])
+        index.indexed_bytes = data["indexed_bytes"]
+        index.first_ts = data["first_ts"]
+        index.last_ts = data["last_ts"]
+        index.records = data["records"]
+        index.txn = data["txn"]
+        index.levels = data["levels"]
+        index.times = [tuple(entry) for entry in data["times"]]
+        return index
+
+class LogIndex:
+    """Query AdvancedLogger output by transaction id, level and time range.
+
+    One index file per segment is kept in <log_dir>/.index, named after the
+    segment fingerprint. update() only reads bytes appended since the last
+    run and follows rotation: renamed segments keep their index, and indexes
+    of segments deleted by rotation are removed.
+
+    Compressed segments in the archive (see ArchivingFileHandler) are not
+    indexed; a query stream-decompresses only the archived segments whose
+    manifest time range overlaps [since, until] and filters their records.
+    """
+    STREAMS = {"main": "{app}.log", "error": "{app}-error.log"}
+
+    def __init__(self, log_dir="logs", app_name="fintech-app", index_dir=None, archive_dir=None):
+        self.log_dir = log_dir
+        self.app_name = app_name
+        self.index_dir = index_dir or os.path.join(log_dir, ".index")
+        self.archive_dir = archive_dir or os.path.join(log_dir, "archive")
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._segments = {}
+
+    def _segment_files(self, stream):
+        """Return the paths of one stream's segments, oldest first"""
+        base = self.STREAMS[stream].format(app=self.app_name)
+        pattern = re.compile(re.escape(base) + r"(?:\.(\d+))?$")
+        found = []
+        for filename in os.listdir(self.log_dir):
+            match = pattern.match(filename)
+            if match:
+                number = int(match.group(1)) if match.group(1) else 0
+                found.append((number, os.path.join(self.log_dir, filename)))
+        # app.log.5 is the oldest and app.log the newest
+        return [path for _, path in sorted(found, reverse=True)]
+
+    def _load(self, fingerprint):
+        index = self._segments.get(fingerprint)
+        if index is None:
+            path = os.path.join(self.index_dir, f"{fingerprint}.json")
+            try:
+                with open(path, "r") as f:
+                    index = SegmentIndex.from_dict(json.load(f))
+            except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                index = SegmentIndex(fingerprint)
+            self._segments[fingerprint] = index
+        return index
+
+    def _save(self, index):
+        path = os.path.join(self.index_dir, f"{index.fingerprint}.json")
+        atomic_write(path, json.dumps(index.to_dict(), separators=(",", ":")).encode("utf-8"))
+
+    def update(self, stream="main"):
+        """Bring the index up to date; return [(path, SegmentIndex)] oldest first"""
+        segments = []
+        for path in self._segment_files(stream):
+            try:
+                fingerprint = _fingerprint(path)
+            except FileNotFoundError:
+                # Rotated away between listing and reading
+                continue
+            if fingerprint is None:
+                continue
+            index = self._load(fingerprint)
+            if os.path.getsize(path) < index.indexed_bytes:
+                # Same head but shorter: the file was truncated, start over
+                index = self._segments[fingerprint] = SegmentIndex(fingerprint)
+            if index.update(path):
+                self._save(index)
+            segments.append((path, index))
+        return segments
+
+    def prune(self):
+        """Delete index files whose segments no longer exist"""
+        live = set()
+        for stream in self.STREAMS:
+            for path in self._segment_files(stream):
+                try:
+                    live.add(_fingerprint(path))
+                except FileNotFoundError:
+                    pass
+        for filename in os.listdir(self.index_dir):
+            fingerprint, ext = os.path.splitext(filename)
+            if ext == ".json" and fingerprint not in live:
+                os.remove(os.path.join(self.index_dir, filename))
+                self._segments.pop(fingerprint, None)
+
+    def archived_segments(self, stream="main", since=None, until=None):
+        """Return the paths of archived segments overlapping [since, until], oldest first"""
+        base = self.STREAMS[stream].format(app=self.app_name)
+        paths = []
+        for segment in read_manifest(self.archive_dir, base):
+            # Segments archived from an earlier run may not have a range yet
+            if segment["first_ts"] is not None:
+                if since is not None and segment["last_ts"] < since - CLOCK_SLACK:
+                    continue
+                if until is not None and segment["first_ts"] > until + CLOCK_SLACK:
+                    continue
+            paths.append(os.path.join(self.archive_dir, segment["file"]))
+        return paths
+
+    def query(self, transaction_id=None, level=None, since=None, until=None, stream="main",
+              include_archive=True):
+        """Yield matching records (parsed dicts) in time order"""
+        if include_archive:
+            for path in self.archived_segments(stream, since, until):
+                yield from self._scan_archived(path, transaction_id, level, since, until)
+
+        segments = self.update(stream)
+        self.prune()
+        for path, index in segments:
+            if index.first_ts is None:
+                continue
+            if since is not None and index.last_ts < since:
+                continue
+            if until is not None and index.first_ts > until:
+                continue
+
+            start, end = index.offset_range(since, until)
+            candidates = None
+            if transaction_id is not None:
+                candidates = index.txn.get(str(transaction_id), [])
+            if level is not None:
+                offsets = index.levels.get(level.upper(), [])
+                lo, hi = bisect_left(offsets, start), bisect_left(offsets, end)
+                level_offsets = offsets[lo:hi]
+                if candidates is None:
+                    candidates = level_offsets
+                else:
+                    wanted = set(level_offsets)
+                    candidates = [offset for offset in candidates if offset in wanted]
+            yield from self._read(path, index, candidates, start, end, since, until)
+
+    def _read(self, path, index, candidates, start, end, since, until):
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if candidates is None:
+                # Time range only: scan the narrowed byte range
+                f.seek(start)
+                lines = iter(lambda: f.readline() if f.tell() < end else b"", b"")
+            else:
+                lines = (self._read_line(f, offset) for offset in candidates
+                         if start <= offset < end)
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                    ts = parse_timestamp(record["timestamp"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts > until:
+                    continue
+                yield record
+
+    def _scan_archived(self, path, transaction_id, level, since, until):
+        # A segment listed uncompressed may have been compressed since
+        for candidate in [path] + [path + suffix for suffix in COMPRESSION_SUFFIXES.values()]:
+            try:
+                f = open_segment(candidate)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            # Expired since the manifest was read
+            return
+        needle = str(transaction_id).encode("utf-8") if transaction_id is not None else None
+        with f:
+            for line in f:
+                # Cheap byte test before parsing the record
+                if needle is not None and needle not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    ts = parse_timestamp(record["timestamp"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if until is not None and ts > until + CLOCK_SLACK:
+                    # Records are (nearly) in time order; the rest is later still
+                    return
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts > until:
+                    continue
+                if level is not None and record.get("level") != level.upper():
+                    continue
+                if transaction_id is not None:
+                    message = record.get("message")
+                    if not isinstance(message, dict) or str(message.get("transaction_id")) != str(transaction_id):
+                        continue
+                yield record
+
+    @staticmethod
+    def _read_line(f, offset):
+        f.seek(offset)
+        return f.readline()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query AdvancedLogger logs through an index")
+    parser.add_argument("--log-dir", default="logs")
+    parser.add_argument("--app", default="fintech-app")
+    parser.add_argument("--txn", help="Transaction id to trace")
+    parser.add_argument("--level", help="Only records of this level, e.g. ERROR")
+    parser.add_argument("--since", help="Start of the time range: 5m, 2h, 1d or ISO datetime")
+    parser.add_argument("--until", help="End of the time range, same formats as --since")
+    parser.add_argument("--stream", choices=sorted(LogIndex.STREAMS), default="main")
+    parser.add_argument("--rebuild", action="store_true", help="Discard the index and rebuild it")
+    parser.add_argument("--no-archive", action="store_true",
+                        help="Only search the live log files, not the compressed archive")
+    args = parser.parse_args(argv)
+
+    log_index = LogIndex(args.log_dir, args.app)
+    if args.rebuild:
+        for filename in os.listdir(log_index.index_dir):
+            os.remove(os.path.join(log_index.index_dir, filename))
+
+    start_time = time.perf_counter()
+    count = 0
+    for record in log_index.query(
+        transaction_id=args.txn,
+        level=args.level,
+        since=parse_time_arg(args.since) if args.since else None,
+        until=parse_time_arg(args.until) if args.until else None,
+        stream=args.stream,
+        include_archive=not args.no_archive
+    ):
+        print(json.dumps(record))
+        count += 1
+    elapsed = time.perf_counter() - start_time
+    print(f"{count} records in {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,111 +1,608 @@
 import time
 import threading
-import json
 import os
+import sys
+from bisect import bisect_left
+
+from quantile_sketch import DDSketch
+from persistence import DeltaLog, write_snapshot
+from multiprocess import MultiProcessCollector, worker_path
+from tsdb import TimeSeriesDB
+
+DEFAULT_BUCKETS = [0.1, 0.5, 1.0, 2.0, 5.0]
+DEFAULT_QUANTILES = [0.5, 0.95, 0.99]
+# Label value used for series created after a family hits its cardinality cap
+OVERFLOW_LABEL_VALUE = "__overflow__"
+# snapshot: keep the latest values in <app>_metrics.json
+# timeseries: append changes to <app>_metrics.jsonl, keeping history
+PERSIST_MODES = ("snapshot", "timeseries", "both")
+
+def linear_buckets(start, width, count):
+    """Return count bucket boundaries starting at start, width apart"""
+    return [start + width * i for i in range(count)]
+
+def exponential_buckets(start, factor, count):
+    """Return count bucket boundaries starting at start, each factor times the last"""
+    return [start * factor ** i for i in range(count)]
+
+class _Shard:
+    """Metric values written by a single thread.
+
+    Only the owning thread ever writes to a shard, so updates need no lock.
+    Readers copy the dicts (an atomic operation under the GIL) and merge
+    all shards together when a snapshot is taken. Values are keyed by the
+    metric name, or by an interned (name, label values) tuple for series of
+    a labelled family. The version counter is bumped on every update so
+    readers can tell cheaply whether anything changed.
+    """
+    __slots__ = ("thread", "version", "counters", "gauges", "histograms", "summaries")
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.version = 0
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.summaries = {}
+
+    def absorb(self, other):
+        """Fold the values of another (no longer written) shard into this one"""
+        self.version += other.version
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, value in other.gauges.items():
+            self.gauges[key] = self.gauges.get(key, 0) + value
+        for key, state in other.histograms.items():
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = [state[0], state[1], list(state[2])]
+            else:
+                mine[0] += state[0]
+                mine[1] += state[1]
+                mine[2] = [a + b for a, b in zip(mine[2], state[2])]
+        for key, sketch in other.summaries.items():
+            mine = self.summaries.get(key)
+            if mine is None:
+                self.summaries[key] = sketch.copy()
+            else:
+                mine.merge(sketch)
 
 class MetricsCollector:
-       def __init__(self, app_name, metrics_dir="metrics"):
+       def __init__(self, app_name, metrics_dir="metrics", max_series_per_metric=1000,
+                    save_interval=10, persist_mode="snapshot", multiprocess_dir=None,
+                    tsdb_dir=None):
+           if persist_mode not in PERSIST_MODES:
+               raise ValueError(f"persist_mode must be one of {PERSIST_MODES}")
            self.app_name = app_name
            self.metrics_dir = metrics_dir
-           self.metrics = {
+           self.save_interval = save_interval
+           self.persist_mode = persist_mode
+           # Default cap on label combinations per labelled metric family
+           self.max_series_per_metric = max_series_per_metric
+           # Metric definitions only; values live in the per-thread shards
+           self.definitions = {
                "counters": {},
                "gauges": {},
-               "histograms": {}
+               "histograms": {},
+               "summaries": {}
            }
+           # Guards the definitions and the shard list, never taken on updates
            self.lock = threading.Lock()
-           
+
+           # Per-thread storage, merged only when metrics are read
+           self._local = threading.local()
+           self._shards = []
+           self._retired = _Shard(None)
+           self._compact_threshold = 64
+           # Offsets applied by Gauge.set on top of the summed shard deltas
+           self._gauge_offsets = {}
+           # Bumped on changes that do not go through a shard
+           self._version = 0
+
            # Create metrics directory
            os.makedirs(metrics_dir, exist_ok=True)
-           
+           self.snapshot_path = f"{metrics_dir}/{app_name}_metrics.json"
+
+           # In multiprocess mode (e.g. gunicorn workers) every process writes
+           # its own file and the shared snapshot holds the merged view
+           self.multiprocess_dir = multiprocess_dir or os.environ.get("METRICS_MULTIPROC_DIR")
+           self.multiprocess = None
+           delta_log_path = f"{metrics_dir}/{app_name}_metrics.jsonl"
+           if self.multiprocess_dir:
+               os.makedirs(self.multiprocess_dir, exist_ok=True)
+               self.worker_path = worker_path(self.multiprocess_dir, app_name, os.getpid())
+               self.multiprocess = MultiProcessCollector(self.multiprocess_dir, app_name, self)
+               delta_log_path = f"{metrics_dir}/{app_name}_metrics.{os.getpid()}.jsonl"
+
+           self.delta_log = None
+           if persist_mode in ("timeseries", "both"):
+               self.delta_log = DeltaLog(delta_log_path)
+           # History for dashboards; with several processes only the one
+           # holding the store's writer lock appends the merged snapshot
+           self.tsdb_dir = tsdb_dir
+           self.tsdb = None
+           self._saved_generation = None
+           # Serializes saves from the background thread and stop()
+           self._save_lock = threading.Lock()
+
            # Start background thread to save metrics periodically
            self.running = True
+           self._stop_event = threading.Event()
            self.bg_thread = threading.Thread(target=self._background_save)
            self.bg_thread.daemon = True
            self.bg_thread.start()
-       
-       def counter(self, name, description=""):
+
+       def _define(self, kind, name, description, labels, max_series, **extra):
+           """Register a metric definition once (lock held)"""
+           if name not in self.definitions[kind]:
+               self._version += 1
+               self.definitions[kind][name] = {
+                   **extra,
+                   "description": description,
+                   "labels": [str(label) for label in labels],
+                   "max_series": max_series or self.max_series_per_metric,
+                   # Label value tuples of the series created so far
+                   "series": []
+               }
+
+       def counter(self, name, description="", labels=(), max_series=None):
            """Create a counter metric"""
            with self.lock:
-               if name not in self.metrics["counters"]:
-                   self.metrics["counters"][name] = {
-                       "value": 0,
-                       "description": description
-                   }
+               self._define("counters", name, description, labels, max_series)
            return Counter(self, name)
-       
-       def gauge(self, name, description=""):
+
+       def gauge(self, name, description="", labels=(), max_series=None):
            """Create a gauge metric"""
            with self.lock:
-               if name not in self.metrics["gauges"]:
-                   self.metrics["gauges"][name] = {
-                       "value": 0,
-                       "description": description
-                   }
+               self._define("gauges", name, description, labels, max_series)
            return Gauge(self, name)
-       
-       def histogram(self, name, buckets=[0.1, 0.5, 1.0, 2.0, 5.0], description=""):
+
+       def histogram(self, name, buckets=DEFAULT_BUCKETS, description="", labels=(),
+                     max_series=None):
            """Create a histogram metric"""
            with self.lock:
-               if name not in self.metrics["histograms"]:
-                   self.metrics["histograms"][name] = {
-                       "count": 0,
-                       "sum": 0,
-                       "buckets": {str(b): 0 for b in buckets},
-                       "description": description
-                   }
+               self._define("histograms", name, description, labels, max_series,
+                            buckets=sorted(set(buckets)))
            return Histogram(self, name)
-       
+
+       def summary(self, name, quantiles=DEFAULT_QUANTILES, description="",
+                   relative_accuracy=0.01, max_bins=2048, labels=(), max_series=None):
+           """Create a summary metric backed by a quantile sketch"""
+           with self.lock:
+               self._define("summaries", name, description, labels, max_series,
+                            quantiles=sorted(quantiles),
+                            relative_accuracy=relative_accuracy,
+                            max_bins=max_bins)
+           return Summary(self, name)
+
+       sketch = summary
+
+       def _shard(self):
+           """Return the calling thread's shard, creating it on first use"""
+           try:
+               return self._local.shard
+           except AttributeError:
+               return self._register_shard()
+
+       def _register_shard(self):
+           shard = _Shard(threading.current_thread())
+           with self.lock:
+               # Servers that spawn a thread per request leave many dead
+               # shards behind, so compact them once the list grows
+               if len(self._shards) >= self._compact_threshold:
+                   self._retire_dead_shards()
+                   self._compact_threshold = max(64, 2 * len(self._shards))
+               self._shards.append(shard)
+           self._local.shard = shard
+           return shard
+
+       def _retire_dead_shards(self):
+           """Fold shards of finished threads into the retired shard (lock held)"""
+           alive = []
+           for shard in self._shards:
+               if shard.thread.is_alive():
+                   alive.append(shard)
+               else:
+                   self._retired.absorb(shard)
+           self._shards = alive
+
+       def _copy_shards(self):
+           """Take a point-in-time copy of every shard (lock held)"""
+           self._retire_dead_shards()
+           copies = []
+           for shard in [self._retired] + self._shards:
+               histograms = {}
+               for key, state in shard.histograms.copy().items():
+                   histograms[key] = (state[0], state[1], list(state[2]))
+               summaries = {
+                   key: sketch.copy() for key, sketch in shard.summaries.copy().items()
+               }
+               copies.append((shard.counters.copy(), shard.gauges.copy(), histograms, summaries))
+           return copies
+
+       def _gauge_delta(self, key):
+           """Sum of all gauge deltas recorded by the shards (lock held)"""
+           total = self._retired.gauges.get(key, 0)
+           for shard in self._shards:
+               total += shard.gauges.get(key, 0)
+           return total
+
+       def get_counter(self, key):
+           """Return the current merged value of a counter series"""
+           with self.lock:
+               total = self._retired.counters.get(key, 0)
+               for shard in self._shards:
+                   total += shard.counters.get(key, 0)
+           return total
+
+       def get_gauge(self, key):
+           """Return the current merged value of a gauge series"""
+           with self.lock:
+               return self._gauge_delta(key) + self._gauge_offsets.get(key, 0)
+
+       def set_gauge(self, key, value):
+           with self.lock:
+               self._gauge_offsets[key] = value - self._gauge_delta(key)
+               self._version += 1
+
+       def generation(self):
+           """Return a number that increases whenever any metric value changes.
+
+           Cheap compared to snapshot(): it only sums the shard version
+           counters, so exporters use it to decide whether a cached
+           rendering is still current.
+           """
+           with self.lock:
+               total = self._version + self._retired.version
+               for shard in self._shards:
+                   total += shard.version
+           return total
+
+       def snapshot(self):
+           """Merge all shards into the exported metrics structure"""
+           with self.lock:
+               copies = self._copy_shards()
+               definitions = {
+                   kind: {
+                       name: dict(info, series=list(info["series"]))
+                       for name, info in metrics.items()
+                   }
+                   for kind, metrics in self.definitions.items()
+               }
+               gauge_offsets = dict(self._gauge_offsets)
+
+           counters = {}
+           gauges = dict(gauge_offsets)
+           histograms = {}
+           summaries = {}
+           for shard_counters, shard_gauges, shard_histograms, shard_summaries in copies:
+               for key, value in shard_counters.items():
+                   counters[key] = counters.get(key, 0) + value
+               for key, value in shard_gauges.items():
+                   gauges[key] = gauges.get(key, 0) + value
+               for key, (count, total, buckets) in shard_histograms.items():
+                   merged = histograms.get(key)
+                   if merged is None:
+                       histograms[key] = [count, total, buckets]
+                   else:
+                       merged[0] += count
+                       merged[1] += total
+                       merged[2] = [a + b for a, b in zip(merged[2], buckets)]
+               for key, sketch in shard_summaries.items():
+                   merged = summaries.get(key)
+                   if merged is None:
+                       summaries[key] = sketch
+                   else:
+                       merged.merge(sketch)
+
+           def scalar(values):
+               def export(info, keys):
+                   return {"value": sum(values.get(key, 0) for key in keys)}
+               return export
+
+           def histogram(info, keys):
+               count, total = 0, 0
+               counts = [0] * (len(info["buckets"]) + 1)
+               for key in keys:
+                   state = histograms.get(key)
+                   if state is not None:
+                       count += state[0]
+                       total += state[1]
+                       counts = [a + b for a, b in zip(counts, state[2])]
+               return {
+                   "count": count,
+                   "sum": total,
+                   "buckets": _cumulative_buckets(info["buckets"], counts)
+               }
+
+           def summary(info, keys):
+               merged = DDSketch(info["relative_accuracy"], info["max_bins"])
+               for key in keys:
+                   if key in summaries:
+                       merged.merge(summaries[key])
+               return {
+                   "count": merged.count,
+                   "sum": merged.sum,
+                   "quantiles": {str(q): merged.quantile(q) for q in info["quantiles"]},
+                   "sketch": merged.to_dict()
+               }
+
+           return {
+               "counters": _export_kind(definitions["counters"], scalar(counters)),
+               "gauges": _export_kind(definitions["gauges"], scalar(gauges)),
+               "histograms": _export_kind(definitions["histograms"], histogram),
+               "summaries": _export_kind(definitions["summaries"], summary)
+           }
+
+       def save(self):
+           """Persist the current metrics if anything changed since the last save.
+
+           Only the shard copy in snapshot() runs under the collector lock;
+           serialization and disk I/O happen afterwards, so request threads
+           are never blocked by a slow write.
+           """
+           with self._save_lock:
+               generation = self.generation()
+               if generation == self._saved_generation:
+                   return False
+               snapshot = self.snapshot()
+               now = time.time()
+               merged = None
+               if self.multiprocess is not None:
+                   write_snapshot(self.worker_path, snapshot)
+               if self.persist_mode in ("snapshot", "both"):
+                   merged = self._merged(snapshot)
+                   write_snapshot(self.snapshot_path, merged)
+               if self.delta_log is not None:
+                   self.delta_log.append(now, snapshot)
+               if self.tsdb_dir is not None and self._open_tsdb():
+                   self.tsdb.append(now, merged or self._merged(snapshot))
+               self._saved_generation = generation
+               return True
+
+       def _merged(self, snapshot):
+           """The snapshot of all processes, or just this one's"""
+           if self.multiprocess is not None:
+               return self.multiprocess.snapshot()
+           return snapshot
+
+       def _open_tsdb(self):
+           if self.tsdb is None:
+               try:
+                   self.tsdb = TimeSeriesDB(self.tsdb_dir)
+               except BlockingIOError:
+                   # Another process writes the history; try again next save
+                   return False
+           return True
+
        def _background_save(self):
            """Save metrics to disk periodically"""
            while self.running:
-               with self.lock:
-                   with open(f"{self.metrics_dir}/{self.app_name}_metrics.json", "w") as f:
-                       json.dump(self.metrics, f, indent=2)
-               time.sleep(10)  # Save every 10 seconds
-       
+               try:
+                   self.save()
+               except OSError as e:
+                   print(f"Error saving metrics: {e}")
+               self._stop_event.wait(self.save_interval)
+
        def stop(self):
-           """Stop the background thread"""
+           """Stop the background thread and write a final save"""
            self.running = False
+           self._stop_event.set()
            self.bg_thread.join()
-           
-class Counter:
-    def __init__(self, collector, name):
+           self.save()
+           if self.tsdb is not None:
+               self.tsdb.close()
+
+def _export_kind(definitions, export):
+    """Build the exported entries of one metric kind.
+
+    Unlabelled metrics keep the flat shape. Labelled families export the
+    total across all series plus a "series" list with one entry per label
+    combination.
+    """
+    exported = {}
+    for name, info in definitions.items():
+        if not info["labels"]:
+            entry = export(info, [name])
+        else:
+            keys = [(name, values) for values in info["series"]]
+            entry = export(info, keys)
+            entry["labels"] = info["labels"]
+            entry["series"] = [
+                {"labels": dict(zip(info["labels"], values)), **export(info, [key])}
+                for values, key in zip(info["series"], keys)
+            ]
+        entry["description"] = info["description"]
+        exported[name] = entry
+    return exported
+
+def _cumulative_buckets(bounds, counts):
+    """Convert per-bucket counts into the exported cumulative "le" buckets"""
+    buckets = {}
+    running = 0
+    for bound, count in zip(bounds, counts):
+        running += count
+        buckets[str(bound)] = running
+    return buckets
+
+class _Metric:
+    """Shared handle logic for metrics and the children of labelled families.
+
+    A metric created with labels is a family: values are recorded through
+    the child returned by labels(). Children are cached per label value
+    tuple, so resolving an existing child is a single dict lookup.
+    """
+    kind = None
+
+    def __init__(self, collector, name, labelvalues=None):
         self.collector = collector
         self.name = name
-    
-    def inc(self, value=1):
+        info = collector.definitions[self.kind][name]
+        self.labelnames = info["labels"]
+        self.labelvalues = labelvalues
+        # Shard key: the plain name, or an interned (name, label values) tuple
+        self.key = name if labelvalues is None else (name, labelvalues)
+        self._is_family = bool(self.labelnames) and labelvalues is None
+        self._children = {}
+        self._overflow = None
+        self._setup(info)
+
+    def _setup(self, info):
+        pass
+
+    def _check_family(self):
+        if self._is_family:
+            raise ValueError(f"Metric {self.name} has labels {self.labelnames}; use labels() first")
+
+    def labels(self, *values, **labelkwargs):
+        """Return the child handle for one combination of label values"""
+        if labelkwargs:
+            try:
+                values = tuple(labelkwargs[label] for label in self.labelnames)
+            except KeyError as e:
+                raise ValueError(f"Missing label {e} for metric {self.name}")
+        child = self._children.get(values)
+        if child is None:
+            child = self._resolve_child(values)
+        return child
+
+    def _resolve_child(self, values):
+        if not self.labelnames:
+            raise ValueError(f"Metric {self.name} has no labels")
+        if len(values) != len(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} expects {len(self.labelnames)} label values, got {len(values)}"
+            )
+        normalized = tuple(sys.intern(str(value)) for value in values)
+
         with self.collector.lock:
-            self.collector.metrics["counters"][self.name]["value"] += value
+            child = self._children.get(normalized)
+            if child is None:
+                info = self.collector.definitions[self.kind][self.name]
+                if len(info["series"]) >= info["max_series"]:
+                    # Over the cardinality cap: record into a shared overflow
+                    # series and do not cache the offending values
+                    return self._overflow_child(info)
+                child = self.__class__(self.collector, self.name, normalized)
+                info["series"].append(normalized)
+                self.collector._version += 1
+                self._children[normalized] = child
+            # Cache the caller's own tuple too so the next lookup is a hit
+            self._children[values] = child
+        return child
+
+    def _overflow_child(self, info):
+        """Return the series shared by label values over the cap (lock held)"""
+        if self._overflow is None:
+            values = (OVERFLOW_LABEL_VALUE,) * len(self.labelnames)
+            self._overflow = self.__class__(self.collector, self.name, values)
+            info["series"].append(values)
+            self.collector._version += 1
+        return self._overflow
+
+class Counter(_Metric):
+    kind = "counters"
+
+    def inc(self, value=1):
+        self._check_family()
+        shard = self.collector._shard()
+        counters = shard.counters
+        counters[self.key] = counters.get(self.key, 0) + value
+        shard.version += 1
+
+    def get(self):
+        return self.collector.get_counter(self.key)
+
+class Gauge(_Metric):
+    kind = "gauges"
 
-class Gauge:
-    def __init__(self, collector, name):
-        self.collector = collector
-        self.name = name
-    
     def set(self, value):
-        with self.collector.lock:
-            self.collector.metrics["gauges"][self.name]["value"] = value
-    
+        self._check_family()
+        self.collector.set_gauge(self.key, value)
+
     def inc(self, value=1):
-        with self.collector.lock:
-            self.collector.metrics["gauges"][self.name]["value"] += value
-    
+        self._check_family()
+        shard = self.collector._shard()
+        gauges = shard.gauges
+        gauges[self.key] = gauges.get(self.key, 0) + value
+        shard.version += 1
+
     def dec(self, value=1):
-        with self.collector.lock:
-            self.collector.metrics["gauges"][self.name]["value"] -= value
+        self._check_family()
+        shard = self.collector._shard()
+        gauges = shard.gauges
+        gauges[self.key] = gauges.get(self.key, 0) - value
+        shard.version += 1
+
+    def get(self):
+        return self.collector.get_gauge(self.key)
+
+class Histogram(_Metric):
+    kind = "histograms"
+
+    def _setup(self, info):
+        # Sorted upper bounds; counts has one extra slot for values above the last
+        self.bounds = [float(b) for b in info["buckets"]]
 
-class Histogram:
-    def __init__(self, collector, name):
-        self.collector = collector
-        self.name = name
-    
     def observe(self, value):
-        with self.collector.lock:
-            metrics = self.collector.metrics["histograms"][self.name]
-            metrics["count"] += 1
-            metrics["sum"] += value
-            
-            # Update buckets
-            for bucket in metrics["buckets"]:
-                if value <= float(bucket):
-                    metrics["buckets"][bucket] += 1
\ No newline at end of file
+        self._check_family()
+        shard = self.collector._shard()
+        histograms = shard.histograms
+        state = histograms.get(self.key)
+        if state is None:
+            state = histograms[self.key] = [0, 0, [0] * (len(self.bounds) + 1)]
+        state[0] += 1
+        state[1] += value
+        # First bucket whose upper bound is >= value
+        state[2][bisect_left(self.bounds, value)] += 1
+        shard.version += 1
+
+    def observe_many(self, values):
+        """Observe several values with one shard lookup and one version bump"""
+        self._check_family()
+        shard = self.collector._shard()
+        histograms = shard.histograms
+        state = histograms.get(self.key)
+        if state is None:
+            state = histograms[self.key] = [0, 0, [0] * (len(self.bounds) + 1)]
+        bounds = self.bounds
+        buckets = state[2]
+        count = 0
+        total = 0
+        for value in values:
+            buckets[bisect_left(bounds, value)] += 1
+            count += 1
+            total += value
+        state[0] += count
+        state[1] += total
+        shard.version += 1
+
+class Summary(_Metric):
+    kind = "summaries"
+
+    def _setup(self, info):
+        self.relative_accuracy = info["relative_accuracy"]
+        self.max_bins = info["max_bins"]
+
+    def observe(self, value):
+        self._check_family()
+        shard = self.collector._shard()
+        summaries = shard.summaries
+        sketch = summaries.get(self.key)
+        if sketch is None:
+            sketch = summaries[self.key] = DDSketch(self.relative_accuracy, self.max_bins)
+        sketch.add(value)
+        shard.version += 1
+
+    def observe_many(self, values):
+        """Observe several values with one shard lookup and one version bump"""
+        self._check_family()
+        shard = self.collector._shard()
+        summaries = shard.summaries
+        sketch = summaries.get(self.key)
+        if sketch is None:
+            sketch = summaries[self.key] = DDSketch(self.relative_accuracy, self.max_bins)
+        add = sketch.add
+        for value in values:
+            add(value)
+        shard.version += 1
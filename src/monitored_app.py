@@ -1,27 +1,57 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 import time
 import random
 import os
 import json
 import sys
+from itertools import islice
 
 # Import our custom modules
-from advanced_logging import AdvancedLogger
-from metrics import MetricsCollector
+from advanced_logging import AdvancedLogger, LogRateLimiter
+from metrics import MetricsCollector, exponential_buckets
+from exposition import MetricsExporter, negotiate_format
+from batch_ingest import iter_records
+from live_stream import MetricsStream, SSE_CONTENT_TYPE
+from tracing import Tracer, FileSpanExporter
 
-# Create our advanced logger
-logger = AdvancedLogger("fintech-app")
+# Create metrics collector; every save is also kept as history for dashboards
+metrics = MetricsCollector("fintech-app", tsdb_dir="metrics/tsdb")
 
-# Create metrics collector
-metrics = MetricsCollector("fintech-app")
+# Create our advanced logger; request threads only enqueue records and a
+# background writer does the formatting and disk I/O. Repeated messages
+# (e.g. "Transaction 1234 failed" during an incident) are rate limited per
+# template so they cannot rotate the useful history out of the log files
+logger = AdvancedLogger("fintech-app", async_mode=True, overflow_policy="drop_debug",
+                        metrics=metrics,
+                        rate_limiter=LogRateLimiter(rate=10.0, burst=50, always_keep=100))
+
+# Per-stage span histograms for every request; 1% of traces (plus any the
+# caller marked as sampled) are written to logs/spans.jsonl
+tracer = Tracer("fintech-app", metrics=metrics, sample_rate=0.01,
+                exporter=FileSpanExporter("logs/spans.jsonl", dropped_counter=metrics.counter(
+                    "spans_dropped_total", "Sampled spans dropped because the export queue was full")))
 
 # Define metrics
-transaction_counter = metrics.counter("transactions_total", "Total number of transactions processed")
-error_counter = metrics.counter("transaction_errors_total", "Total number of transaction errors")
+transaction_counter = metrics.counter("transactions_total", "Total number of transactions processed",
+                                      labels=["currency", "type"])
+error_counter = metrics.counter("transaction_errors_total", "Total number of transaction errors",
+                                labels=["error_code"])
 active_requests = metrics.gauge("active_requests", "Number of requests currently being processed")
-transaction_duration = metrics.histogram("transaction_duration_seconds", 
-                                         [0.1, 0.5, 1.0, 2.0, 5.0], 
-                                         "Transaction processing duration in seconds")
+transaction_duration = metrics.histogram("transaction_duration_seconds",
+                                         # 25ms to ~6.5s in 2x steps, plus the old boundaries
+                                         sorted(set(exponential_buckets(0.025, 2, 9) + [0.1, 0.5, 1.0, 2.0, 5.0])),
+                                         "Transaction processing duration in seconds",
+                                         labels=["currency", "status"])
+transaction_latency = metrics.summary("transaction_latency_seconds",
+                                      [0.5, 0.95, 0.99],
+                                      "Transaction processing latency quantiles in seconds")
+
+# Renders /metrics from in-memory snapshots, cached until a value changes
+# With METRICS_MULTIPROC_DIR set, /metrics merges every worker process
+exporter = MetricsExporter(metrics.multiprocess or metrics)
+
+# One producer pushes coalesced metric deltas to every live dashboard viewer
+live_stream = MetricsStream(exporter, interval=1.0)
 
 app = Flask(__name__)
 
@@ -34,60 +64,185 @@ def home():
 def process_transaction():
     start_time = time.time()
     active_requests.inc()
+    currency = None
+    status_code = 500
     
-    try:
-        # Simulate transaction processing
-        transaction_data = request.json or {}
-        transaction_id = random.randint(1000, 9999)
-        
-        # Log transaction details with metadata
-        logger.info(
-            f"Processing transaction {transaction_id}",
-            transaction_id=transaction_id,
-            amount=transaction_data.get('amount'),
-            currency=transaction_data.get('currency'),
-            user_id=transaction_data.get('user_id')
-        )
-        
-        # Increment transaction counter
-        transaction_counter.inc()
-        
-        # Simulate processing time
+    # Continue the load generator's trace when it sent a traceparent header
+    with tracer.start_trace("process_transaction", request.headers.get('traceparent')):
+        try:
+            # Simulate transaction processing
+            with tracer.span("parse_json"):
+                transaction_data = request.json or {}
+            currency = transaction_data.get('currency')
+            transaction_id = random.randint(1000, 9999)
+            
+            # Log transaction details with metadata
+            with tracer.span("log"):
+                logger.info(
+                    f"Processing transaction {transaction_id}",
+                    transaction_id=transaction_id,
+                    amount=transaction_data.get('amount'),
+                    currency=currency,
+                    user_id=transaction_data.get('user_id')
+                )
+                
+                # Increment transaction counter
+                transaction_counter.labels(currency, transaction_data.get('type')).inc()
+            
+            # Simulate processing time
+            with tracer.span("process"):
+                processing_time = random.uniform(0.1, 2.0)
+                time.sleep(processing_time)
+            
+            # Randomly generate errors for testing
+            if random.random() < 0.1:  # 10% chance of error
+                error_counter.labels("PROC_ERR_001").inc()
+                logger.error(
+                    f"Transaction {transaction_id} failed",
+                    transaction_id=transaction_id,
+                    error_code="PROC_ERR_001",
+                    processing_time=processing_time
+                )
+                with tracer.span("serialize"):
+                    return jsonify({"status": "error", "message": "Transaction failed"}), 500
+            
+            logger.info(
+                f"Transaction {transaction_id} completed successfully",
+                transaction_id=transaction_id,
+                processing_time=processing_time,
+                status="success"
+            )
+            status_code = 200
+            with tracer.span("serialize"):
+                return jsonify({"status": "success", "transaction_id": transaction_id})
+        finally:
+            # Record processing duration
+            duration = time.time() - start_time
+            transaction_duration.labels(currency, status_code).observe(duration)
+            transaction_latency.observe(duration)
+            active_requests.dec()
+
+# Records parsed, processed and answered together by the batch endpoint
+BATCH_CHUNK_RECORDS = 500
+
+def _process_chunk(chunk, totals):
+    """Process one chunk of (index, record, error) and return its NDJSON results"""
+    start_time = time.time()
+    results = []
+    counts = {}
+    statuses = {}
+    failed_ids = []
+    
+    # One simulated downstream call per chunk instead of one per transaction
+    with tracer.span("process", records=len(chunk)):
         processing_time = random.uniform(0.1, 2.0)
         time.sleep(processing_time)
-        
-        # Randomly generate errors for testing
-        if random.random() < 0.1:  # 10% chance of error
-            error_counter.inc()
+        for index, record, error in chunk:
+            if error is None and not isinstance(record, dict):
+                error = "Record must be a JSON object"
+            if error is not None:
+                totals["invalid"] += 1
+                results.append({"index": index, "status": "invalid", "error": error})
+                continue
+            currency = record.get('currency')
+            transaction_id = random.randint(1000, 9999)
+            key = (currency, record.get('type'))
+            counts[key] = counts.get(key, 0) + 1
+            # Same 10% simulated failure rate as single transactions
+            if random.random() < 0.1:
+                failed_ids.append(transaction_id)
+                status_code = 500
+                results.append({"index": index, "status": "error", "transaction_id": transaction_id,
+                                "message": "Transaction failed"})
+            else:
+                status_code = 200
+                results.append({"index": index, "status": "success", "transaction_id": transaction_id})
+            statuses[(currency, status_code)] = statuses.get((currency, status_code), 0) + 1
+    
+    # Metrics and logs once per chunk and label combination, not per record
+    with tracer.span("log"):
+        for (currency, transaction_type), count in counts.items():
+            transaction_counter.labels(currency, transaction_type).inc(count)
+        if failed_ids:
+            error_counter.labels("PROC_ERR_001").inc(len(failed_ids))
             logger.error(
-                f"Transaction {transaction_id} failed",
-                transaction_id=transaction_id,
+                f"{len(failed_ids)} transactions in batch failed",
                 error_code="PROC_ERR_001",
+                transaction_ids=failed_ids,
                 processing_time=processing_time
             )
-            return jsonify({"status": "error", "message": "Transaction failed"}), 500
-        
+        valid = sum(statuses.values())
         logger.info(
-            f"Transaction {transaction_id} completed successfully",
-            transaction_id=transaction_id,
-            processing_time=processing_time,
-            status="success"
+            f"Processed batch of {len(chunk)} transactions",
+            records=len(chunk),
+            succeeded=valid - len(failed_ids),
+            failed=len(failed_ids),
+            processing_time=processing_time
         )
-        return jsonify({"status": "success", "transaction_id": transaction_id})
-    finally:
-        # Record processing duration
         duration = time.time() - start_time
-        transaction_duration.observe(duration)
-        active_requests.dec()
+        for (currency, status_code), count in statuses.items():
+            transaction_duration.labels(currency, status_code).observe_many([duration] * count)
+        transaction_latency.observe_many([duration] * valid)
+    
+    totals["total"] += len(chunk)
+    totals["failed"] += len(failed_ids)
+    totals["succeeded"] += valid - len(failed_ids)
+    with tracer.span("serialize"):
+        return "".join(json.dumps(result) + "\n" for result in results)
+
+@app.route('/api/transactions/batch', methods=['POST'])
+def process_transaction_batch():
+    # A JSON array or NDJSON body (Content-Type: application/x-ndjson), parsed
+    # while it is read; one NDJSON result line per record is streamed back
+    # as each chunk finishes, followed by a summary line
+    records = enumerate(iter_records(request.stream, request.mimetype))
+    traceparent = request.headers.get('traceparent')
+    
+    def generate():
+        active_requests.inc()
+        totals = {"total": 0, "succeeded": 0, "failed": 0, "invalid": 0}
+        try:
+            with tracer.start_trace("process_transaction_batch", traceparent):
+                while True:
+                    with tracer.span("parse_json"):
+                        chunk = [(index, record, error) for index, (record, error)
+                                 in islice(records, BATCH_CHUNK_RECORDS)]
+                    if not chunk:
+                        break
+                    yield _process_chunk(chunk, totals)
+            yield json.dumps({"summary": totals}) + "\n"
+        finally:
+            active_requests.dec()
+    
+    return Response(stream_with_context(generate()), content_type='application/x-ndjson')
 
 @app.route('/metrics')
 def get_metrics():
-    # Return metrics in a format similar to Prometheus
-    with open(f"metrics/fintech-app_metrics.json", "r") as f:
-        return jsonify(json.load(f))
+    # Prometheus text for scrapers, JSON for everything else
+    fmt = negotiate_format(request.headers.get('Accept'), request.args.get('format'))
+    payload, content_type = exporter.render(fmt)
+    return Response(payload, content_type=content_type)
+
+@app.route('/metrics/stream')
+def metrics_stream():
+    # Browsers send Last-Event-ID on reconnect to resume from missed deltas
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID'))
+    except (TypeError, ValueError):
+        last_event_id = None
+    return Response(live_stream.subscribe(last_event_id), content_type=SSE_CONTENT_TYPE,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/dashboard/live')
+def live_dashboard():
+    return render_template('live_dashboard.html', app_name=metrics.app_name)
 
 if __name__ == '__main__':
     try:
-        app.run(debug=True, host='0.0.0.0', port=5000)
+        # threaded so long-lived /metrics/stream connections don't block requests
+        app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
     finally:
+        live_stream.stop()
+        tracer.close()
+        logger.close()
         metrics.stop()
\ No newline at end of file
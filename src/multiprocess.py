@@ -0,0 +1,233 @@
+import json
+import os
+import re
+import time
+
+from quantile_sketch import DDSketch
+from persistence import write_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows: dead worker cleanup is skipped
+    fcntl = None
+
+# How to combine one gauge reported by several live workers
+GAUGE_POLICIES = ("sum", "max", "min", "mean")
+
+def worker_path(multiprocess_dir, app_name, pid):
+    return os.path.join(multiprocess_dir, f"{app_name}_{pid}.json")
+
+def _merge_values(kind, values_list, policy):
+    """Merge the value fields of one series as reported by several workers"""
+    if kind == "counters":
+        return {"value": sum(values["value"] for values in values_list)}
+
+    if kind == "gauges":
+        numbers = [values["value"] for values in values_list]
+        if policy == "max":
+            value = max(numbers)
+        elif policy == "min":
+            value = min(numbers)
+        elif policy == "mean":
+            value = sum(numbers) / len(numbers)
+        else:
+            value = sum(numbers)
+        return {"value": value}
+
+    if kind == "histograms":
+        buckets = {}
+        for values in values_list:
+            for bound, count in values["buckets"].items():
+                buckets[bound] = buckets.get(bound, 0) + count
+        return {
+            "count": sum(values["count"] for values in values_list),
+            "sum": sum(values["sum"] for values in values_list),
+            "buckets": dict(sorted(buckets.items(), key=lambda item: float(item[0])))
+        }
+
+    # Summaries: merge the sketches and recompute the quantiles
+    sketch = None
+    for values in values_list:
+        other = DDSketch.from_dict(values["sketch"])
+        if sketch is None:
+            sketch = other
+        else:
+            sketch.merge(other)
+    return {
+        "count": sketch.count,
+        "sum": sketch.sum,
+        "quantiles": {q: sketch.quantile(float(q)) for q in values_list[0]["quantiles"]},
+        "sketch": sketch.to_dict()
+    }
+
+def _merge_entries(kind, entries, policy):
+    """Merge the exported entries of one metric from several workers"""
+    first = entries[0]
+    merged = _merge_values(kind, entries, policy)
+    if "series" in first:
+        grouped = {}
+        for entry in entries:
+            for series in entry.get("series", []):
+                key = tuple(series["labels"].items())
+                grouped.setdefault(key, []).append(series)
+        merged["labels"] = first["labels"]
+        merged["series"] = [
+            {"labels": dict(key), **_merge_values(kind, series_list, policy)}
+            for key, series_list in grouped.items()
+        ]
+    merged["description"] = first.get("description", "")
+    return merged
+
+def merge_snapshots(snapshots, gauge_policy="sum", gauge_policies=None):
+    """Combine MetricsCollector snapshots from several processes into one.
+
+    Counters and histogram buckets are summed, summary sketches are merged
+    and their quantiles recomputed, and gauges are combined with
+    gauge_policy (or the per-gauge override in gauge_policies).
+    """
+    gauge_policies = gauge_policies or {}
+    merged = {}
+    for kind in ("counters", "gauges", "histograms", "summaries"):
+        grouped = {}
+        for snapshot in snapshots:
+            for name, entry in snapshot.get(kind, {}).items():
+                grouped.setdefault(name, []).append(entry)
+        merged[kind] = {
+            name: _merge_entries(kind, entries, gauge_policies.get(name, gauge_policy))
+            for name, entries in grouped.items()
+        }
+    return merged
+
+def _pid_alive(pid):
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows; rely on staleness
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+class MultiProcessCollector:
+    """Merged view over the metrics of every worker sharing multiprocess_dir.
+
+    Each worker's MetricsCollector writes its own snapshot to
+    <dir>/<app>_<pid>.json. This class merges those files with the live
+    snapshot of the local collector. Files of dead workers have their
+    counters, histograms and summaries folded into <dir>/<app>_archive.json
+    and are removed; their gauges are dropped since they no longer describe
+    a running process. It offers generation() and snapshot() so it can be
+    used with MetricsExporter in place of a single collector. Without a
+    local collector it merges the files only, e.g. for dashboard.py.
+    """
+
+    def __init__(self, multiprocess_dir, app_name, collector=None, gauge_policy="sum",
+                 gauge_policies=None, stale_after=None):
+        if gauge_policy not in GAUGE_POLICIES:
+            raise ValueError(f"gauge_policy must be one of {GAUGE_POLICIES}")
+        self.multiprocess_dir = multiprocess_dir
+        self.app_name = app_name
+        # The local collector, read live instead of through its file
+        self.collector = collector
+        self.gauge_policy = gauge_policy
+        self.gauge_policies = gauge_policies or {}
+        # Treat workers that have not written for this long as dead
+        self.stale_after = stale_after
+        self._pattern = re.compile(re.escape(self.app_name) + r"_(\d+)\.json$")
+
+    def _worker_files(self):
+        files = []
+        for filename in os.listdir(self.multiprocess_dir):
+            match = self._pattern.match(filename)
+            if match:
+                files.append((int(match.group(1)), os.path.join(self.multiprocess_dir, filename)))
+        return sorted(files)
+
+    def generation(self):
+        """Changes whenever the local collector or any worker file changes"""
+        state = []
+        for pid, path in self._worker_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            state.append((pid, stat.st_mtime_ns, stat.st_size))
+        local = self.collector.generation() if self.collector is not None else None
+        return (local, tuple(state))
+
+    def _is_dead(self, pid, path):
+        if self.collector is not None and pid == os.getpid():
+            return False
+        if not _pid_alive(pid):
+            return True
+        if self.stale_after is not None:
+            try:
+                return time.time() - os.path.getmtime(path) > self.stale_after
+            except FileNotFoundError:
+                return True
+        return False
+
+    def _archive_dead(self, dead):
+        """Fold dead worker files into the archive and remove them"""
+        if not dead or fcntl is None:
+            return
+        lock_path = os.path.join(self.multiprocess_dir, f"{self.app_name}.lock")
+        archive_path = os.path.join(self.multiprocess_dir, f"{self.app_name}_archive.json")
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                archived = [_read_json(archive_path) or {}]
+                folded = []
+                for pid, path in dead:
+                    snapshot = _read_json(path)
+                    if snapshot is None:
+                        continue
+                    snapshot.pop("gauges", None)
+                    archived.append(snapshot)
+                    folded.append(path)
+                if not folded:
+                    return
+                write_snapshot(archive_path, merge_snapshots(archived))
+                for path in folded:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        """Return the merged snapshot of all live workers plus the archive"""
+        snapshots = []
+        dead = []
+        for pid, path in self._worker_files():
+            if self.collector is not None and pid == os.getpid():
+                continue
+            if self._is_dead(pid, path):
+                dead.append((pid, path))
+                continue
+            snapshot = _read_json(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+
+        self._archive_dead(dead)
+        archive = _read_json(os.path.join(self.multiprocess_dir, f"{self.app_name}_archive.json"))
+        if archive is not None:
+            snapshots.append(archive)
+        if self.collector is not None:
+            snapshots.append(self.collector.snapshot())
+        return merge_snapshots(snapshots, self.gauge_policy, self.gauge_policies)
+
+def collect(multiprocess_dir, app_name, gauge_policy="sum", gauge_policies=None):
+    """Merge the metrics of all workers of app_name from outside the app"""
+    return MultiProcessCollector(multiprocess_dir, app_name, gauge_policy=gauge_policy,
+                                 gauge_policies=gauge_policies).snapshot()
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+
+from exposition import iter_samples
+
+def atomic_write(path, data):
+    """Write bytes to path so readers only ever see the old or the new file.
+
+    The data goes to a temporary file in the same directory, is fsynced and
+    then renamed over the target, which is atomic on POSIX and Windows.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def write_snapshot(path, snapshot):
+    """Atomically replace path with the compact JSON encoding of a snapshot"""
+    atomic_write(path, json.dumps(snapshot, separators=(",", ":")).encode("utf-8"))
+
+class DeltaLog:
+    """Append-only time series of metric snapshots stored as JSON lines.
+
+    Each line holds a timestamp and only the samples that changed since the
+    previous line: cumulative samples (counters, histogram buckets, sums and
+    counts) under "inc" as increments, gauges and quantiles under "set" as
+    their new value. Every full_every records, and at the start of each
+    process, a full record with absolute values is written so a reader can
+    start from there and so counter resets on restart are explicit.
+    """
+
+    def __init__(self, path, full_every=60):
+        self.path = path
+        self.full_every = full_every
+        self._previous = None
+        self._since_full = 0
+
+        # Terminate a line left half-written by a crash so it cannot swallow
+        # the next record
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def append(self, timestamp, snapshot):
+        """Append the changes in snapshot; return False if nothing changed"""
+        samples = {series: (value, cumulative)
+                   for series, value, cumulative in iter_samples(snapshot)}
+        full = self._previous is None or self._since_full >= self.full_every
+
+        increments, values = {}, {}
+        for series, (value, cumulative) in samples.items():
+            previous = None if full else self._previous.get(series)
+            if cumulative:
+                delta = value if previous is None else value - previous[0]
+                if delta or full:
+                    increments[series] = delta
+            elif previous is None or value != previous[0]:
+                values[series] = value
+
+        if not full and not increments and not values:
+            return False
+        record = {"ts": timestamp, "full": full, "inc": increments, "set": values}
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with open(self.path, "a") as f:
+            f.write(line)
+            f.flush()
+
+        self._since_full = 0 if full else self._since_full + 1
+        self._previous = samples
+        return True
+
+def read_delta_log(path):
+    """Replay a DeltaLog, yielding (timestamp, {series: absolute value})"""
+    values = {}
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a truncated last line; skip it
+                continue
+            if record["full"]:
+                values = {}
+            for series, delta in record["inc"].items():
+                values[series] = values.get(series, 0) + delta
+            values.update(record["set"])
+            yield record["ts"], dict(values)
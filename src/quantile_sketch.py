@@ -0,0 +1,133 @@
+import math
+
+class DDSketch:
+    """Mergeable quantile sketch with bounded relative error.
+
+    Values are mapped to logarithmic bins so that every quantile estimate is
+    within relative_accuracy of the true value. Memory is capped at max_bins;
+    if more bins are needed the lowest ones are collapsed, which only affects
+    the accuracy of the smallest quantiles. Two sketches with the same
+    relative accuracy merge exactly by adding their bin counts, so sketches
+    from different threads or processes can be combined.
+
+    Intended for non-negative values such as durations; values at or below
+    zero are counted in a dedicated zero bin.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        """Record a single value"""
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) * self.multiplier)
+        bins = self.bins
+        if key in bins:
+            bins[key] += 1
+        else:
+            bins[key] = 1
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def _collapse(self):
+        """Fold the lowest bins together until the sketch fits in max_bins"""
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            self.bins[target] += self.bins.pop(key)
+
+    def _value(self, key):
+        # Midpoint of the bin in relative terms, so the error is symmetric
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Return the estimated value at quantile q (0 <= q <= 1)"""
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return min(max(0, self.min), self.max)
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return min(max(self._value(key), self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        """Add the contents of another sketch with the same accuracy to this one"""
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        if other.count == 0:
+            return
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def copy(self):
+        sketch = DDSketch(self.relative_accuracy, self.max_bins)
+        sketch.bins = self.bins.copy()
+        sketch.zero_count = self.zero_count
+        sketch.count = self.count
+        sketch.sum = self.sum
+        sketch.min = self.min
+        sketch.max = self.max
+        return sketch
+
+    def to_dict(self):
+        """Serialize to a JSON-compatible dict"""
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "zero_count": self.zero_count,
+            "bins": {str(key): count for key, count in self.bins.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a sketch serialized with to_dict"""
+        sketch = cls(data["relative_accuracy"], data.get("max_bins", 2048))
+        sketch.bins = {int(key): count for key, count in data["bins"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if data["count"]:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
@@ -1,3 +1,4 @@
+import argparse
 import requests
 import time
 import random
@@ -6,6 +7,10 @@ import json
 import os
 from datetime import datetime
 
+from latency_histogram import LatencyHistogram
+from persistence import atomic_write
+from tracing import new_traceparent
+
 def generate_transaction():
     """Generate a random transaction"""
     return {
@@ -16,28 +21,117 @@ def generate_transaction():
         "description": "Test transaction"
     }
 
-def send_transactions(server_url, num_transactions, results_file, thread_id):
+RESULTS_DIR = "load_tests/results"
+
+class ResultRecorder:
+    """Stream load test results to <worker>_results.jsonl as they arrive.
+
+    Each result is appended as one compact JSON line and the file is flushed
+    every flush_every results or flush_interval seconds, so a crashed run
+    keeps what it recorded. Durations also go into a LatencyHistogram that
+    close() saves to <worker>_histogram.json for the final merge; no result
+    is kept in memory.
+    """
+
+    def __init__(self, worker, results_dir=RESULTS_DIR, flush_every=100, flush_interval=1.0):
+        os.makedirs(results_dir, exist_ok=True)
+        self.worker = worker
+        self.results_path = os.path.join(results_dir, f"{worker}_results.jsonl")
+        self.histogram_path = os.path.join(results_dir, f"{worker}_histogram.json")
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        # A histogram left by an earlier run must not stand in for this one
+        if os.path.exists(self.histogram_path):
+            os.remove(self.histogram_path)
+        self.file = open(self.results_path, "w")
+        self.histogram = LatencyHistogram()
+        self.total = 0
+        self.successful = 0
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def record(self, result):
+        self.file.write(json.dumps(result, separators=(",", ":")) + "\n")
+        self.total += 1
+        if result.get("success", False):
+            self.successful += 1
+        if "duration" in result:
+            self.histogram.record(result["duration"])
+        self._pending += 1
+        if self._pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def stats(self):
+        return {"total": self.total, "successful": self.successful,
+                "latency": self.histogram.to_dict()}
+
+    def close(self):
+        """Flush the results file and save the histogram"""
+        self.flush()
+        self.file.close()
+        atomic_write(self.histogram_path, json.dumps(self.stats()).encode("utf-8"))
+
+def load_worker_stats(worker, results_dir=RESULTS_DIR):
+    """Return (total, successful, LatencyHistogram) recorded by one worker.
+
+    Uses the saved histogram, or replays the JSONL results if the worker
+    never closed its recorder (e.g. the run crashed).
+    """
+    try:
+        with open(os.path.join(results_dir, f"{worker}_histogram.json"), "r") as f:
+            stats = json.load(f)
+        return stats["total"], stats["successful"], LatencyHistogram.from_dict(stats["latency"])
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    total = successful = 0
+    histogram = LatencyHistogram()
+    with open(os.path.join(results_dir, f"{worker}_results.jsonl"), "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line cut short by the crash
+                continue
+            total += 1
+            if result.get("success", False):
+                successful += 1
+            if "duration" in result:
+                histogram.record(result["duration"])
+    return total, successful, histogram
+
+def send_transactions(server_url, num_transactions, recorder, thread_id):
     """Send a batch of transactions and record results"""
-    results = []
+    # One session per thread reuses its keep-alive connection
+    session = requests.Session()
     
     for i in range(num_transactions):
         transaction = generate_transaction()
+        # Each request starts a trace the server continues, so results and
+        # server spans can be joined on trace_id
+        traceparent, trace_id = new_traceparent()
         start_time = time.time()
         
         try:
-            response = requests.post(
+            response = session.post(
                 f"{server_url}/api/transactions",
                 json=transaction,
-                headers={"Content-Type": "application/json"}
+                headers={"Content-Type": "application/json", "traceparent": traceparent}
             )
             
             duration = time.time() - start_time
             status = response.status_code
             success = 200 <= status < 300
             
-            results.append({
+            recorder.record({
                 "transaction_id": i,
                 "thread_id": thread_id,
+                "trace_id": trace_id,
                 "duration": duration,
                 "status_code": status,
                 "success": success,
@@ -45,9 +139,10 @@ def send_transactions(server_url, num_transactions, results_file, thread_id):
             })
             
         except Exception as e:
-            results.append({
+            recorder.record({
                 "transaction_id": i,
                 "thread_id": thread_id,
+                "trace_id": trace_id,
                 "error": str(e),
                 "success": False,
                 "timestamp": datetime.now().isoformat()
@@ -56,25 +151,86 @@ def send_transactions(server_url, num_transactions, results_file, thread_id):
         # Random delay between requests
         time.sleep(random.uniform(0.1, 0.5))
     
-    # Save results to file
-    with open(results_file, 'w') as f:
-        json.dump(results, f, indent=2)
+    recorder.close()
+
+def send_transaction_batches(server_url, num_transactions, recorder, thread_id, batch_size):
+    """Send transactions as streamed NDJSON batches and record every result"""
+    session = requests.Session()
+    
+    for first in range(0, num_transactions, batch_size):
+        count = min(batch_size, num_transactions - first)
+        traceparent, trace_id = new_traceparent()
+        # The body is generated while it is sent (chunked transfer encoding)
+        body = (json.dumps(generate_transaction()).encode("utf-8") + b"\n" for _ in range(count))
+        start_time = time.time()
+        received = 0
+        
+        try:
+            response = session.post(
+                f"{server_url}/api/transactions/batch",
+                data=body,
+                headers={"Content-Type": "application/x-ndjson", "traceparent": traceparent},
+                stream=True
+            )
+            # Results stream back per chunk; each record's latency is the
+            # time until its result line arrived
+            for line in response.iter_lines():
+                result = json.loads(line)
+                if "summary" in result:
+                    continue
+                received += 1
+                recorder.record({
+                    "transaction_id": first + result["index"],
+                    "thread_id": thread_id,
+                    "trace_id": trace_id,
+                    "duration": time.time() - start_time,
+                    "status_code": response.status_code,
+                    "success": result["status"] == "success",
+                    "timestamp": datetime.now().isoformat()
+                })
+            error = None if received == count else f"{count - received} results missing"
+        except Exception as e:
+            error = str(e)
+        
+        if error is not None:
+            for i in range(received, count):
+                recorder.record({
+                    "transaction_id": first + i,
+                    "thread_id": thread_id,
+                    "trace_id": trace_id,
+                    "error": error,
+                    "success": False,
+                    "timestamp": datetime.now().isoformat()
+                })
+        
+        # Random delay between batches
+        time.sleep(random.uniform(0.1, 0.5))
+    
+    recorder.close()
 
 def run_load_test(server_url="http://localhost:5000", 
                  num_threads=5, 
-                 transactions_per_thread=20):
-    """Run a multi-threaded load test"""
-    os.makedirs("load_tests/results", exist_ok=True)
+                 transactions_per_thread=20,
+                 batch_size=None):
+    """Run a multi-threaded load test, in batches of batch_size if given"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
     
     threads = []
     for i in range(num_threads):
-        results_file = f"load_tests/results/thread_{i}_results.json"
-        thread = threading.Thread(
-            target=send_transactions,
-            args=(server_url, transactions_per_thread, results_file, i)
-        )
+        recorder = ResultRecorder(f"thread_{i}")
+        if batch_size:
+            thread = threading.Thread(
+                target=send_transaction_batches,
+                args=(server_url, transactions_per_thread, recorder, i, batch_size)
+            )
+        else:
+            thread = threading.Thread(
+                target=send_transactions,
+                args=(server_url, transactions_per_thread, recorder, i)
+            )
         threads.append(thread)
     
+    start_time = time.monotonic()
     # Start all threads
     for thread in threads:
         thread.start()
@@ -82,51 +238,103 @@ def run_load_test(server_url="http://localhost:5000",
     # Wait for all threads to complete
     for thread in threads:
         thread.join()
+    elapsed = time.monotonic() - start_time
     
     # Aggregate results
-    aggregate_results(num_threads)
+    return aggregate_results(num_threads, extra={
+        "engine": "threads",
+        "batch_size": batch_size,
+        "achieved_rps": num_threads * transactions_per_thread / elapsed if elapsed else 0
+    })
 
-def aggregate_results(num_threads):
+def aggregate_results(num_threads, extra=None):
     """Aggregate results from all threads"""
-    all_results = []
-    
-    for i in range(num_threads):
+    return merge_worker_results([f"thread_{i}" for i in range(num_threads)], extra)
+
+def merge_worker_results(workers, extra=None):
+    """Merge the per-worker histograms and counts, then summarize them"""
+    total = successful = 0
+    histogram = LatencyHistogram()
+    for worker in workers:
         try:
-            with open(f"load_tests/results/thread_{i}_results.json", 'r') as f:
-                thread_results = json.load(f)
-                all_results.extend(thread_results)
-        except:
-            print(f"Error reading results from thread {i}")
-    
-    # Calculate statistics
-    durations = [r.get('duration', 0) for r in all_results if 'duration' in r]
-    success_count = sum(1 for r in all_results if r.get('success', False))
-    
-    if durations:
-        avg_duration = sum(durations) / len(durations)
-        max_duration = max(durations)
-        min_duration = min(durations)
-    else:
-        avg_duration = max_duration = min_duration = 0
-    
+            worker_total, worker_successful, worker_histogram = load_worker_stats(worker)
+        except (FileNotFoundError, KeyError, ValueError):
+            print(f"Error reading results from {worker}")
+            continue
+        total += worker_total
+        successful += worker_successful
+        histogram.merge(worker_histogram)
+    return summarize_results(histogram, total, successful, extra)
+
+def summarize_results(histogram, total, successful, extra=None):
+    """Compute summary statistics, save them and print the headline numbers"""
     # Save summary
     summary = {
-        "total_transactions": len(all_results),
-        "successful_transactions": success_count,
-        "success_rate": success_count / len(all_results) if all_results else 0,
-        "avg_duration": avg_duration,
-        "max_duration": max_duration,
-        "min_duration": min_duration,
+        "total_transactions": total,
+        "successful_transactions": successful,
+        "success_rate": successful / total if total else 0,
+        "avg_duration": histogram.mean() or 0,
+        "max_duration": histogram.percentile(100) or 0,
+        "min_duration": histogram.percentile(0) or 0,
+        "p50_duration": histogram.percentile(50) or 0,
+        "p90_duration": histogram.percentile(90) or 0,
+        "p99_duration": histogram.percentile(99) or 0,
+        "p99_9_duration": histogram.percentile(99.9) or 0,
         "timestamp": datetime.now().isoformat()
     }
+    if extra:
+        summary.update(extra)
     
-    with open("load_tests/results/summary.json", 'w') as f:
+    with open(os.path.join(RESULTS_DIR, "summary.json"), 'w') as f:
         json.dump(summary, f, indent=2)
+    # The merged histogram, so later runs or tools can recompute any percentile
+    with open(os.path.join(RESULTS_DIR, "latency_histogram.json"), 'w') as f:
+        json.dump(histogram.to_dict(), f)
     
     print("Load test completed!")
-    print(f"Total transactions: {len(all_results)}")
+    print(f"Total transactions: {total}")
     print(f"Success rate: {summary['success_rate']:.2%}")
-    print(f"Average duration: {avg_duration:.4f}s")
+    print(f"Average duration: {summary['avg_duration']:.4f}s")
+    print(f"Latency p50 {summary['p50_duration']:.4f}s  p90 {summary['p90_duration']:.4f}s  "
+          f"p99 {summary['p99_duration']:.4f}s  p99.9 {summary['p99_9_duration']:.4f}s  "
+          f"max {summary['max_duration']:.4f}s")
+    return summary
 
 if __name__ == "__main__":
-    run_load_test()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load test the transaction API")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--engine", choices=["threads", "async", "processes"], default="threads",
+                        help="threads: one OS thread per user; async: asyncio event loop; "
+                             "processes: asyncio engine in --workers processes")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed",
+                        help="closed: users wait for each response; open: Poisson arrivals at --rps (not threads)")
+    parser.add_argument("--users", type=int, default=5, help="Concurrent users (closed mode)")
+    parser.add_argument("--transactions", type=int, default=20, help="Transactions per user (closed mode)")
+    parser.add_argument("--rps", type=float, default=50.0, help="Target arrival rate (open mode)")
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds (not threads)")
+    parser.add_argument("--connections", type=int, default=100, help="Keep-alive connection pool size (not threads)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (processes engine)")
+    parser.add_argument("--batch-size", type=int,
+                        help="Send transactions in NDJSON batches of this size to /api/transactions/batch (threads)")
+    args = parser.parse_args()
+
+    if args.batch_size and args.engine != "threads":
+        parser.error("--batch-size requires --engine threads")
+    if args.engine == "threads":
+        if args.mode == "open":
+            parser.error("--mode open requires --engine async or processes")
+        run_load_test(args.url, args.users, args.transactions, args.batch_size)
+    elif args.engine == "processes":
+        from load_coordinator import LoadCoordinator
+        duration = args.duration or (30.0 if args.mode == "open" else None)
+        LoadCoordinator(args.url, args.workers).run(
+            args.mode, args.users, args.rps, duration,
+            args.transactions if args.mode == "closed" else None, args.connections
+        )
+    else:
+        from async_load import run_async_load_test
+        duration = args.duration or (30.0 if args.mode == "open" else None)
+        run_async_load_test(args.url, args.mode, args.users, args.rps, duration,
+                            args.transactions if args.mode == "closed" else None,
+                            args.connections)
\ No newline at end of file
@@ -0,0 +1,236 @@
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+from metrics import exponential_buckets
+
+# 100us to ~6.5s in 4x steps: wide enough for both parsing and processing stages
+SPAN_BUCKETS = exponential_buckets(0.0001, 4, 9)
+
+# The span active in the current thread or asyncio task
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+def _new_trace_id():
+    return "%032x" % random.getrandbits(128)
+
+def _new_span_id():
+    return "%016x" % random.getrandbits(64)
+
+def parse_traceparent(header):
+    """Return (trace_id, parent span id, sampled) from a W3C traceparent header, or None"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+def new_traceparent(sampled=False):
+    """Return (traceparent header, trace id) for a request starting a new trace"""
+    trace_id = _new_trace_id()
+    return f"00-{trace_id}-{_new_span_id()}-{'01' if sampled else '00'}", trace_id
+
+def current_span():
+    """The active span, or None outside of any trace"""
+    return _current_span.get()
+
+class Span:
+    """One timed operation within a trace; use it as a context manager"""
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "sampled",
+                 "attributes", "start", "duration", "error", "_token")
+
+    def __init__(self, tracer, name, trace_id, parent_id, sampled, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        """Header value that makes a downstream request a child of this span"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def __enter__(self):
+        self.start = time.time()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.time() - self.start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.tracer._finish(self)
+        return False
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+class FileSpanExporter:
+    """Append finished spans to a JSON lines file from a background thread.
+
+    Request threads only put the span on a bounded queue; the writer drains
+    up to batch_size spans, encodes them and writes them with one write and
+    one flush per batch. When the queue is full the span is dropped and
+    counted instead of blocking the request.
+    """
+    _STOP = object()
+
+    def __init__(self, path="logs/spans.jsonl", queue_size=10000, batch_size=512,
+                 flush_interval=1.0, dropped_counter=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.dropped_counter = dropped_counter
+        self._closed = False
+        self.file = open(path, "a")
+
+        self.thread = threading.Thread(target=self._run, name="span-exporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def export(self, span):
+        if self._closed:
+            return
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped_counter is not None:
+                self.dropped_counter.inc()
+
+    def _run(self):
+        encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+        while True:
+            try:
+                span = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            stop = span is self._STOP
+            if not stop:
+                batch.append(span)
+            while len(batch) < self.batch_size and not stop:
+                try:
+                    span = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if span is self._STOP:
+                    stop = True
+                else:
+                    batch.append(span)
+            if batch:
+                try:
+                    self.file.write("".join(encode(span.to_dict()) + "\n" for span in batch))
+                    self.file.flush()
+                except Exception as e:
+                    print(f"Error exporting spans: {e}")
+            if stop:
+                return
+
+    def close(self):
+        """Write out every queued span and close the file"""
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(self._STOP)
+        self.thread.join()
+        self.file.close()
+
+class Tracer:
+    """Create spans, record per-stage latency and export sampled traces.
+
+    Every span's duration is observed in the span_duration_seconds histogram
+    labelled by span name, so the per-stage breakdown covers all requests.
+    Only sampled traces are exported: the decision is made once at the root
+    (head-based), either inherited from an incoming traceparent with the
+    sampled flag or taken with probability sample_rate, and every child span
+    follows it. This keeps export cost bounded at high request rates.
+    """
+
+    def __init__(self, service, metrics=None, exporter=None, sample_rate=0.01,
+                 buckets=SPAN_BUCKETS):
+        self.service = service
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.stage_duration = None
+        if metrics is not None:
+            self.stage_duration = metrics.histogram("span_duration_seconds", buckets,
+                                                    "Duration of traced spans in seconds",
+                                                    labels=["span"])
+
+    def start_trace(self, name, traceparent=None, **attributes):
+        """Root span of a request, continuing the caller's trace if it sent one"""
+        parent = parse_traceparent(traceparent)
+        if parent is None:
+            trace_id, parent_id, sampled = _new_trace_id(), None, False
+        else:
+            trace_id, parent_id, sampled = parent
+        sampled = sampled or random.random() < self.sample_rate
+        attributes["service"] = self.service
+        return Span(self, name, trace_id, parent_id, sampled, attributes)
+
+    def span(self, name, **attributes):
+        """Child of the active span, or a new trace if there is none"""
+        parent = _current_span.get()
+        if parent is None:
+            return self.start_trace(name, **attributes)
+        return Span(self, name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+
+    def trace(self, name=None):
+        """Decorator that runs the function inside a span"""
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish(self, span):
+        if self.stage_duration is not None:
+            self.stage_duration.labels(span.name).observe(span.duration)
+        if span.sampled and self.exporter is not None:
+            self.exporter.export(span)
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
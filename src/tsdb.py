@@ -0,0 +1,425 @@
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from exposition import iter_samples
+from persistence import atomic_write
+
+try:
+    import fcntl
+except ImportError:  # Windows: single writer is assumed
+    fcntl = None
+
+MAGIC = b"TSD1"
+# Segment header: magic, tier resolution in seconds, segment start (epoch seconds)
+HEADER = struct.Struct("<4sIq")
+# Raw sample: milliseconds since segment start, series id, value
+RAW_RECORD = struct.Struct("<IId")
+# Rollup: milliseconds since segment start, series id, min, max, sum, count, last
+ROLLUP_RECORD = struct.Struct("<IIdddId")
+_OFFSET = struct.Struct("<I")
+
+# name, resolution (seconds, 0 = every save), segment span, default retention
+TIERS = (
+    ("raw", 0, 3600, 2 * 86400),
+    ("1m", 60, 86400, 30 * 86400),
+    ("1h", 3600, 30 * 86400, 365 * 86400),
+)
+# Expected spacing of raw samples (the collector's save interval), used to
+# estimate how many points a query over the raw tier returns
+RAW_INTERVAL = 10
+AGGREGATES = ("auto", "last", "mean", "min", "max")
+
+def metric_name(series):
+    """'transactions_total{currency="USD"}' -> 'transactions_total'"""
+    return series.split("{", 1)[0]
+
+def rate(points):
+    """Per-second increase between consecutive (ts, value) points of a cumulative series.
+
+    A decrease is taken as a counter reset (process restart), so the new
+    value itself is the increase since the reset.
+    """
+    rates = []
+    for (t0, v0), (t1, v1) in zip(points, points[1:]):
+        if t1 <= t0:
+            continue
+        increase = v1 - v0 if v1 >= v0 else v1
+        rates.append((t1, increase / (t1 - t0)))
+    return rates
+
+class _Tier:
+    """One resolution of the store: fixed-width records in time-partitioned segment files"""
+
+    def __init__(self, root, name, resolution, span, retention):
+        self.name = name
+        self.resolution = resolution
+        self.span = span
+        self.retention = retention
+        self.record = RAW_RECORD if resolution == 0 else ROLLUP_RECORD
+        self.dir = os.path.join(root, name)
+        os.makedirs(self.dir, exist_ok=True)
+        self._file = None
+        self._start = None
+
+    def segment_start(self, ts):
+        return int(ts // self.span * self.span)
+
+    def segments(self):
+        """Return [(start, path)] of every segment, oldest first"""
+        found = []
+        for filename in os.listdir(self.dir):
+            match = re.fullmatch(r"(\d+)\.seg", filename)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.dir, filename)))
+        return sorted(found)
+
+    def _open(self, start):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.dir, f"{start}.seg")
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > HEADER.size:
+            # Drop a record left half-written by a crash
+            valid = HEADER.size + (size - HEADER.size) // self.record.size * self.record.size
+            if valid != size:
+                os.truncate(path, valid)
+        elif size:
+            os.truncate(path, 0)
+            size = 0
+        self._file = open(path, "ab")
+        if size == 0:
+            self._file.write(HEADER.pack(MAGIC, self.resolution, start))
+        self._start = start
+
+    def write(self, ts, rows):
+        """Append rows (record fields after the time offset) stamped with ts"""
+        start = self.segment_start(ts)
+        if start != self._start:
+            self._open(start)
+        offset = int((ts - start) * 1000)
+        pack = self.record.pack
+        self._file.write(b"".join(pack(offset, *row) for row in rows))
+        self._file.flush()
+
+    def _search(self, buffer, count, target):
+        """Index of the first record whose offset is >= target milliseconds"""
+        lo, hi = 0, count
+        size = self.record.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _OFFSET.unpack_from(buffer, HEADER.size + mid * size)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read(self, start, end, ids=None):
+        """Yield (ts, series id, *fields) for records in [start, end], in time order.
+
+        Only segments overlapping the range are opened, and inside each one
+        the first and last records are found by binary search over the
+        memory-mapped file, so the cost follows the size of the range.
+        """
+        for segment_start, path in self.segments():
+            if segment_start + self.span <= start or segment_start > end:
+                continue
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                # Removed by retention while listing
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                count = (size - HEADER.size) // self.record.size
+                if count <= 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    first = self._search(buffer, count, max(0, (start - segment_start) * 1000))
+                    last = self._search(buffer, count, (end - segment_start) * 1000 + 1)
+                    view = memoryview(buffer)[HEADER.size + first * self.record.size:
+                                              HEADER.size + last * self.record.size]
+                    try:
+                        rows = [row for row in self.record.iter_unpack(view)
+                                if ids is None or row[1] in ids]
+                    finally:
+                        view.release()
+            for row in rows:
+                yield (segment_start + row[0] / 1000,) + row[1:]
+
+    def last_timestamp(self):
+        for segment_start, path in reversed(self.segments()):
+            count = (os.path.getsize(path) - HEADER.size) // self.record.size
+            if count > 0:
+                with open(path, "rb") as f:
+                    f.seek(HEADER.size + (count - 1) * self.record.size)
+                    offset = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+                return segment_start + offset / 1000
+        return None
+
+    def expire(self, now):
+        """Delete segments that ended more than retention seconds ago"""
+        removed = 0
+        for segment_start, path in self.segments():
+            if segment_start + self.span < now - self.retention and segment_start != self._start:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._start = None
+
+class TimeSeriesDB:
+    """Compact on-disk history of MetricsCollector snapshots.
+
+    Every append() stores one 16-byte record per series in the raw tier and
+    folds the samples into 1 minute and 1 hour rollups (min, max, sum, count
+    and last value), each written once its bucket is complete. Tiers are
+    split into segment files by time (an hour of raw data, a day of 1m
+    rollups, 30 days of 1h rollups); retention deletes whole segments.
+    Timestamps are stored as millisecond offsets from the segment start.
+
+    Series names are mapped to integer ids in series.json. Only one process
+    may write: the writer holds an exclusive lock on writer.lock and opening
+    a second writer raises BlockingIOError. Readers pass readonly=True.
+    """
+
+    def __init__(self, path, retention=None, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        os.makedirs(path, exist_ok=True)
+        retention = retention or {}
+        self.tiers = [_Tier(path, name, resolution, span, retention.get(name, default))
+                      for name, resolution, span, default in TIERS]
+        self._lock = threading.Lock()
+        self._lock_file = None
+        if not readonly and fcntl is not None:
+            self._lock_file = open(os.path.join(path, "writer.lock"), "a")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise BlockingIOError(f"{path} is already open for writing")
+
+        self._series_path = os.path.join(path, "series.json")
+        self._series_mtime = None
+        # series name -> id, id -> series name, metric name -> kind
+        self.series = {}
+        self.names = {}
+        self.metrics = {}
+        self._load_series()
+
+        # Rollup buckets still being filled: tier name -> (bucket start, {id: aggregate})
+        self._pending = {}
+        self._last_ts = None
+        self._last_expire = 0
+        if not readonly:
+            self._recover()
+
+    def _load_series(self):
+        try:
+            mtime = os.path.getmtime(self._series_path)
+        except FileNotFoundError:
+            return
+        if mtime == self._series_mtime:
+            return
+        with open(self._series_path, "r") as f:
+            data = json.load(f)
+        self.series = data["series"]
+        self.names = {series_id: name for name, series_id in self.series.items()}
+        self.metrics = data["metrics"]
+        self._series_mtime = mtime
+
+    def _save_series(self):
+        atomic_write(self._series_path, json.dumps(
+            {"series": self.series, "metrics": self.metrics}, separators=(",", ":")
+        ).encode("utf-8"))
+
+    def _recover(self):
+        """Rebuild the rollup buckets in progress from the raw tier after a restart"""
+        raw = self.tiers[0]
+        self._last_ts = raw.last_timestamp()
+        for tier in self.tiers[1:]:
+            last = tier.last_timestamp()
+            since = 0 if last is None else last + tier.resolution
+            for ts, series_id, value in raw.read(since, float("inf")):
+                self._roll(tier, ts, [(series_id, value)])
+
+    def append(self, timestamp, snapshot):
+        """Record every sample of a MetricsCollector snapshot at timestamp"""
+        if self.readonly:
+            raise ValueError("TimeSeriesDB was opened read-only")
+        with self._lock:
+            # Keep records in time order even if the clock steps back
+            if self._last_ts is not None and timestamp < self._last_ts:
+                timestamp = self._last_ts
+            self._last_ts = timestamp
+
+            changed = False
+            for kind in ("counters", "gauges", "histograms", "summaries"):
+                for name in snapshot.get(kind, {}):
+                    if self.metrics.get(name) != kind:
+                        self.metrics[name] = kind
+                        changed = True
+            samples = []
+            for series, value, _ in iter_samples(snapshot):
+                if value is None:
+                    continue
+                series_id = self.series.get(series)
+                if series_id is None:
+                    series_id = self.series[series] = len(self.series)
+                    self.names[series_id] = series
+                    changed = True
+                samples.append((series_id, float(value)))
+            # Ids are saved before any record that uses them
+            if changed:
+                self._save_series()
+
+            self.tiers[0].write(timestamp, samples)
+            for tier in self.tiers[1:]:
+                self._roll(tier, timestamp, samples)
+            if timestamp - self._last_expire >= 60:
+                self.expire(timestamp)
+
+    def _roll(self, tier, ts, samples):
+        bucket = ts // tier.resolution * tier.resolution
+        pending = self._pending.get(tier.name)
+        if pending is not None and pending[0] != bucket:
+            self._flush_rollup(tier, *pending)
+            pending = None
+        if pending is None:
+            pending = self._pending[tier.name] = (bucket, {})
+        aggregates = pending[1]
+        for series_id, value in samples:
+            aggregate = aggregates.get(series_id)
+            if aggregate is None:
+                aggregates[series_id] = [value, value, value, 1, value]
+            else:
+                if value < aggregate[0]:
+                    aggregate[0] = value
+                if value > aggregate[1]:
+                    aggregate[1] = value
+                aggregate[2] += value
+                aggregate[3] += 1
+                aggregate[4] = value
+
+    def _flush_rollup(self, tier, bucket, aggregates):
+        tier.write(bucket, [(series_id, *aggregate) for series_id, aggregate in sorted(aggregates.items())])
+
+    def expire(self, now=None):
+        """Apply each tier's retention; return the number of segments removed"""
+        now = time.time() if now is None else now
+        self._last_expire = now
+        return sum(tier.expire(now) for tier in self.tiers)
+
+    def pick_tier(self, start, end, max_points=1000, now=None):
+        """The finest tier that still holds start and needs at most max_points per series"""
+        now = time.time() if now is None else now
+        for tier in self.tiers:
+            points = (end - start) / (tier.resolution or RAW_INTERVAL)
+            if points <= max_points and start >= now - tier.retention:
+                return tier
+        return self.tiers[-1]
+
+    def list_metrics(self):
+        """Return {metric name: kind} of every metric stored so far"""
+        if self.readonly:
+            self._load_series()
+        return dict(self.metrics)
+
+    def select(self, names):
+        """Map ids to series names for series or metric names in names"""
+        if self.readonly:
+            self._load_series()
+            series = self.series
+        else:
+            with self._lock:
+                series = dict(self.series)
+        wanted = set(names)
+        return {series_id: name for name, series_id in series.items()
+                if name in wanted or self._family(name) in wanted}
+
+    def _family(self, series):
+        """Metric name a series belongs to, e.g. 'lat' for 'lat_bucket{le="0.5"}'"""
+        name = metric_name(series)
+        if name not in self.metrics:
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and self.metrics.get(name[:-len(suffix)]) in ("histograms", "summaries"):
+                    return name[:-len(suffix)]
+        return name
+
+    def _cumulative(self, series):
+        family = self._family(series)
+        kind = self.metrics.get(family)
+        if kind == "counters":
+            return True
+        # Histogram buckets and histogram/summary sums and counts only grow
+        return kind in ("histograms", "summaries") and family != metric_name(series)
+
+    def query(self, names, start, end=None, tier=None, max_points=1000, aggregate="auto"):
+        """Return {series name: [(ts, value)]} for the series matching names.
+
+        names are series ids (e.g. 'active_requests') or metric names, which
+        match all their label combinations and histogram/summary samples.
+        tier is a tier name, or None to pick one with pick_tier. On rollup
+        tiers aggregate selects the value per bucket: "auto" is the last
+        value for cumulative series and the mean otherwise.
+        """
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"aggregate must be one of {AGGREGATES}")
+        end = time.time() if end is None else end
+        if tier is None:
+            selected = self.pick_tier(start, end, max_points)
+        else:
+            selected = next(t for t in self.tiers if t.name == tier)
+        ids = self.select(names)
+        result = {name: [] for name in ids.values()}
+        if not ids:
+            return result
+
+        modes = {}
+        for row in selected.read(start, end, ids):
+            ts, series_id = row[0], row[1]
+            if selected.resolution == 0:
+                value = row[2]
+            else:
+                mode = modes.get(series_id)
+                if mode is None:
+                    mode = aggregate
+                    if mode == "auto":
+                        mode = "last" if self._cumulative(ids[series_id]) else "mean"
+                    modes[series_id] = mode
+                low, high, total, count, last = row[2:]
+                if mode == "last":
+                    value = last
+                elif mode == "mean":
+                    value = total / count
+                else:
+                    value = low if mode == "min" else high
+            result[ids[series_id]].append((ts, value))
+        return result
+
+    def close(self):
+        """Close the segment files and release the writer lock.
+
+        Rollup buckets still in progress are not written; the next writer
+        rebuilds them from the raw tier, so a bucket is never stored twice.
+        """
+        with self._lock:
+            self._pending.clear()
+            for tier in self.tiers:
+                tier.close()
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                self._lock_file.close()
+                self._lock_file = None